@@ -0,0 +1,251 @@
+"""Замеры памяти и скорости модуля фитнес-трекера.
+
+Запуск: python benchmark.py --sizes 1000 100000 --output results.json
+Сравнение двух прогонов: python benchmark.py --compare old.json new.json
+"""
+import argparse
+import io
+import json
+import platform
+import random
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from homework import (InfoMessage, InfoMessageArray, format_messages,
+                      get_messages, get_messages_threaded, main, read_package)
+
+PACKAGES = [
+    ('SWM', [720, 1, 80, 25, 40]),
+    ('RUN', [15000, 1, 75]),
+    ('WLK', [9000, 1, 75, 180]),
+]
+WORKOUT_TYPES = ('RUN', 'WLK', 'SWM')
+THREAD_COUNTS = (1, 2, 4, 8)
+
+
+def generate_packet(workout_type: str, rng: random.Random) -> Tuple:
+    """Сгенерировать правдоподобный пакет датчиков для тренировки."""
+    action = rng.randint(500, 40000)
+    duration = round(rng.uniform(0.2, 3), 2)
+    weight = round(rng.uniform(45, 120), 1)
+    if workout_type == 'RUN':
+        return workout_type, [action, duration, weight]
+    if workout_type == 'WLK':
+        return workout_type, [action, duration, weight, rng.randint(150, 200)]
+    if workout_type == 'SWM':
+        return workout_type, [action, duration, weight,
+                              rng.choice((25, 50)), rng.randint(10, 80)]
+    raise ValueError(f'Тренировки {workout_type}у нас нет')
+
+
+def generate_packets(workout_type: str,
+                     count: int,
+                     seed: int = 0) -> List[Tuple]:
+    """Сгенерировать count пакетов одного типа тренировки."""
+    rng = random.Random(seed)
+    return [generate_packet(workout_type, rng) for _ in range(count)]
+
+
+def iter_messages(count: int) -> Iterator[InfoMessage]:
+    """Сгенерировать count сообщений по образцовым пакетам."""
+    for index in range(count):
+        package = PACKAGES[index % len(PACKAGES)]
+        yield read_package(*package).show_training_info()
+
+
+def measure_memory(build: Callable) -> int:
+    """Вернуть объём памяти в байтах, занятый результатом build."""
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def measure_time(run: Callable) -> float:
+    """Вернуть время выполнения run в секундах."""
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start
+
+
+def make_result(name: str,
+                workout_type: str,
+                count: int,
+                seconds: Optional[float] = None,
+                bytes_per_record: Optional[float] = None) -> Dict:
+    """Собрать одну запись результатов замера."""
+    result = {'name': name, 'workout_type': workout_type, 'size': count}
+    if seconds is not None:
+        result['seconds'] = seconds
+        result['per_second'] = count / seconds if seconds else None
+    if bytes_per_record is not None:
+        result['bytes_per_record'] = bytes_per_record
+    return result
+
+
+def run_main(packets: List[Tuple]) -> None:
+    """Прогнать пакеты через main с выводом в буфер."""
+    with redirect_stdout(io.StringIO()):
+        for packet in packets:
+            main(read_package(*packet))
+
+
+def compute_metrics(training):
+    """Посчитать метрики тренировки и вернуть её с заполненным кешем."""
+    training.spent_calories
+    return training
+
+
+def bench_training(workout_type: str, count: int) -> List[Dict]:
+    """Замерить этапы обработки пакетов одного типа тренировки."""
+    packets = generate_packets(workout_type, count)
+    messages = [read_package(*packet).show_training_info()
+                for packet in packets]
+    stages = {
+        'read_package': lambda: [read_package(*packet)
+                                 for packet in packets],
+        'get_spent_calories': lambda: [
+            read_package(*packet).get_spent_calories() for packet in packets
+        ],
+        'show_training_info': lambda: [
+            read_package(*packet).show_training_info() for packet in packets
+        ],
+        'get_message': lambda: [message.get_message()
+                                for message in messages],
+        'main': lambda: run_main(packets),
+    }
+    results = [make_result(stage, workout_type, count, measure_time(run))
+               for stage, run in stages.items()]
+    memory = measure_memory(
+        lambda: [read_package(*packet).show_training_info()
+                 for packet in packets])
+    results.append(make_result('info_message_memory', workout_type, count,
+                               bytes_per_record=memory / count))
+    memory = measure_memory(lambda: [read_package(*packet)
+                                     for packet in packets])
+    results.append(make_result('training_memory', workout_type, count,
+                               bytes_per_record=memory / count))
+    memory = measure_memory(lambda: [compute_metrics(read_package(*packet))
+                                     for packet in packets])
+    results.append(make_result('training_memory_computed', workout_type,
+                               count, bytes_per_record=memory / count))
+    return results
+
+
+def bench_info_memory(count: int) -> List[Dict]:
+    """Сравнить память списка InfoMessage и InfoMessageArray."""
+    as_list = measure_memory(lambda: list(iter_messages(count)))
+    as_array = measure_memory(lambda: InfoMessageArray(iter_messages(count)))
+    return [
+        make_result('list_memory', 'ALL', count,
+                    bytes_per_record=as_list / count),
+        make_result('info_message_array_memory', 'ALL', count,
+                    bytes_per_record=as_array / count),
+    ]
+
+
+def bench_format(count: int) -> List[Dict]:
+    """Сравнить цикл по get_message с пакетным format_messages."""
+    messages = list(iter_messages(count))
+    columns = InfoMessageArray(messages)
+    loop = measure_time(
+        lambda: ''.join(message.get_message() + '\n'
+                        for message in messages))
+    bulk = measure_time(lambda: format_messages(messages))
+    bulk_columns = measure_time(lambda: format_messages(columns))
+    return [
+        make_result('get_message_loop', 'ALL', count, loop),
+        make_result('format_messages_list', 'ALL', count, bulk),
+        make_result('format_messages_array', 'ALL', count, bulk_columns),
+    ]
+
+
+def bench_threads(count: int) -> List[Dict]:
+    """Замерить пропускную способность get_messages_threaded по потокам.
+
+    На сборках с GIL рост от числа потоков не ожидается, замер нужен,
+    чтобы увидеть масштабирование на сборках без GIL.
+    """
+    packets = [generate_packet(WORKOUT_TYPES[index % len(WORKOUT_TYPES)],
+                               random.Random(index))
+               for index in range(count)]
+    results = [make_result('get_messages', 'ALL', count,
+                           measure_time(lambda: get_messages(packets)))]
+    for threads in THREAD_COUNTS:
+        seconds = measure_time(lambda: list(get_messages_threaded(
+            packets, max_workers=threads)))
+        results.append(make_result(f'get_messages_threaded_{threads}',
+                                   'ALL', count, seconds))
+    return results
+
+
+def run_benchmarks(sizes: List[int], workout_types: Tuple) -> Dict:
+    """Выполнить все замеры для заданных размеров пачек."""
+    results = []
+    for count in sizes:
+        for workout_type in workout_types:
+            results.extend(bench_training(workout_type, count))
+        results.extend(bench_info_memory(count))
+        results.extend(bench_format(count))
+        results.extend(bench_threads(count))
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def result_key(result: Dict) -> Tuple:
+    """Ключ, по которому сопоставляются замеры разных прогонов."""
+    return result['name'], result['workout_type'], result['size']
+
+
+def compare(old: Dict, new: Dict) -> List[str]:
+    """Сравнить два прогона: отношение нового результата к старому."""
+    old_results = {result_key(result): result for result in old['results']}
+    lines = []
+    for result in new['results']:
+        before = old_results.get(result_key(result))
+        if before is None:
+            continue
+        for field in ('seconds', 'bytes_per_record'):
+            if field in result and before.get(field):
+                ratio = result[field] / before[field]
+                lines.append(f'{result["name"]:<26} '
+                             f'{result["workout_type"]:<4}'
+                             f'{result["size"]:>9} {field:<17}'
+                             f'{ratio:>7.2f}x')
+    return lines
+
+
+def parse_args() -> argparse.Namespace:
+    """Разобрать аргументы командной строки."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10 ** 3, 10 ** 4, 10 ** 5],
+                        help='размеры пачек, от 10 ** 3 до 10 ** 7')
+    parser.add_argument('--types', nargs='+', default=WORKOUT_TYPES,
+                        choices=WORKOUT_TYPES)
+    parser.add_argument('--output', default='bench_results.json',
+                        help='файл для результатов в JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='сравнить два файла результатов')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            print('\n'.join(compare(json.load(old), json.load(new))))
+    else:
+        report = run_benchmarks(args.sizes, tuple(args.types))
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+        for result in report['results']:
+            print(json.dumps(result, ensure_ascii=False))
@@ -1,8 +1,28 @@
-from dataclasses import dataclass
-from typing import List
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from functools import wraps
+from heapq import heappush, heappushpop, nlargest
+from itertools import chain, islice, repeat
+from math import ceil, inf, isfinite, log
+from numbers import Real
+from operator import attrgetter
+from threading import Lock
+from time import perf_counter
+from typing import (TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List,
+                    Optional, TextIO, Tuple, Union)
 
+if TYPE_CHECKING:
+    from datetime import date
 
-@dataclass
+    import numpy
+
+
+@dataclass(slots=True)
 class InfoMessage:
     """Информационное сообщение о тренировке."""
     training_type: str
@@ -19,20 +39,216 @@ class InfoMessage:
                 + f'Потрачено ккал: {self.calories:.3f}.')
 
 
+class InfoMessageArray:
+    """Колонки сообщений о тренировках в типизированных массивах.
+
+    Хранит поля InfoMessage в array вместо отдельного объекта на запись:
+    тип тренировки — индексом в списке названий, остальное — double.
+    Наполнять колонки нужно из одного потока.
+    """
+
+    def __init__(self, messages: Iterable[InfoMessage] = ()) -> None:
+        self.training_types: List[str] = []
+        self.type_index = array('B')
+        self.duration = array('d')
+        self.distance = array('d')
+        self.speed = array('d')
+        self.calories = array('d')
+        self.extend(messages)
+
+    def append(self, message: InfoMessage) -> None:
+        """Добавить сообщение в конец колонок."""
+        if message.training_type not in self.training_types:
+            self.training_types.append(message.training_type)
+        self.type_index.append(
+            self.training_types.index(message.training_type))
+        self.duration.append(message.duration)
+        self.distance.append(message.distance)
+        self.speed.append(message.speed)
+        self.calories.append(message.calories)
+
+    def extend(self, messages: Iterable[InfoMessage]) -> None:
+        """Добавить сообщения в конец колонок."""
+        for message in messages:
+            self.append(message)
+
+    def __len__(self) -> int:
+        return len(self.type_index)
+
+    def __getitem__(self, index: int) -> InfoMessage:
+        return InfoMessage(self.training_types[self.type_index[index]],
+                           self.duration[index],
+                           self.distance[index],
+                           self.speed[index],
+                           self.calories[index])
+
+    def __iter__(self) -> Iterator[InfoMessage]:
+        for index in range(len(self)):
+            yield self[index]
+
+
+MESSAGE_TEMPLATE = ('Тип тренировки: %s; '
+                    'Длительность: %.3f ч.; '
+                    'Дистанция: %.3f км; '
+                    'Ср. скорость: %.3f км/ч; '
+                    'Потрачено ккал: %.3f.\n')
+get_message_fields = attrgetter('training_type', 'duration', 'distance',
+                                'speed', 'calories')
+
+
+def iter_message_rows(messages: Iterable[InfoMessage]) -> Iterator[Tuple]:
+    """Вернуть поля сообщений кортежами в порядке MESSAGE_TEMPLATE."""
+    if isinstance(messages, InfoMessageArray):
+        return zip(map(messages.training_types.__getitem__,
+                       messages.type_index),
+                   messages.duration,
+                   messages.distance,
+                   messages.speed,
+                   messages.calories)
+    return map(get_message_fields, messages)
+
+
+def format_messages(messages: Iterable[InfoMessage]) -> str:
+    """Отформатировать сообщения одной строкой, по записи на строку.
+
+    Каждая строка совпадает с InfoMessage.get_message().
+    """
+    return ''.join(map(MESSAGE_TEMPLATE.__mod__, iter_message_rows(messages)))
+
+
+def write_messages(messages: Iterable[InfoMessage],
+                   output: TextIO,
+                   chunk_size: int = 10000) -> None:
+    """Записать сообщения в output пачками по chunk_size записей."""
+    rows = map(MESSAGE_TEMPLATE.__mod__, iter_message_rows(messages))
+    for chunk in iter_chunks(rows, chunk_size):
+        output.write(''.join(chunk))
+
+
+TRAININGS: Dict[str, type] = {}
+
+
+def metric_input(name: str) -> property:
+    """Поле исходных данных тренировки.
+
+    Значение хранится в слоте '_' + name, запись сбрасывает посчитанные
+    дистанцию, скорость и калории.
+    """
+    slot = '_' + name
+
+    def set_value(training: 'Training', value: float) -> None:
+        setattr(training, slot, value)
+        training.reset_metrics()
+
+    return property(attrgetter(slot), set_value)
+
+
+FIXED_SCALE = 10 ** 6
+INT64_SAFE = 2.0 ** 62
+
+
+def to_fixed(value: float) -> int:
+    """Перевести число в фиксированную точку: миллионные доли."""
+    return round(value * FIXED_SCALE)
+
+
+def check_int64(a, b) -> None:
+    """Проверить, что произведение колонок numpy влезает в int64."""
+    if hasattr(a, 'dtype') or hasattr(b, 'dtype'):
+        if (abs(a * 1.0 * b) >= INT64_SAFE).any():
+            raise OverflowError('Значения вне диапазона фиксированной точки')
+
+
+def fixed_mul(a, b):
+    """Перемножить числа в фиксированной точке с округлением.
+
+    a раскладывается на целую и дробную части, чтобы промежуточное
+    произведение не выходило за int64: результат тот же, что у
+    (a * b + FIXED_SCALE // 2) // FIXED_SCALE.
+    """
+    whole, part = divmod(a, FIXED_SCALE)
+    check_int64(whole, b)
+    check_int64(FIXED_SCALE, b)
+    return whole * b + (part * b + FIXED_SCALE // 2) // FIXED_SCALE
+
+
+def fixed_div(a, b):
+    """Разделить числа в фиксированной точке с округлением, b > 0.
+
+    Результат тот же, что у (a * FIXED_SCALE + b // 2) // b, но
+    множитель FIXED_SCALE применяется только к остатку от деления.
+    """
+    whole, part = divmod(a, b)
+    check_int64(whole, FIXED_SCALE)
+    check_int64(FIXED_SCALE, b)
+    return whole * FIXED_SCALE + (part * FIXED_SCALE + b // 2) // b
+
+
 class Training:
-    """Базовый класс тренировки."""
+    """Базовый класс тренировки.
+
+    Подкласс с параметром code регистрируется в TRAININGS под этим кодом
+    тренировки: class Cycling(Training, code='CYC').
+
+    Дистанция, скорость и калории кешируются в трёх слотах: объект на
+    24 байта больше, чем без кеша, зато посчитанные метрики не требуют
+    отдельного контейнера (замер training_memory в benchmark.py).
+    """
+    __slots__ = ('_action', '_duration', '_weight',
+                 '_distance', '_mean_speed', '_spent_calories', '__dict__')
     M_IN_KM: int = 1000
     LEN_STEP: float = 0.65
     MINS_IN_HOUR: int = 60
+    ARITY: int = 3
+    PARAMETERS: Tuple = ('action', 'duration', 'weight')
+
+    def __init_subclass__(cls, code: Optional[str] = None, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        cls.ARITY = cls.__init__.__code__.co_argcount - 1
+        cls.PARAMETERS = cls.__init__.__code__.co_varnames[1:cls.ARITY + 1]
+        if code is not None:
+            if code in TRAININGS:
+                raise ValueError(f'Тренировка {code} уже зарегистрирована')
+            TRAININGS[code] = cls
 
     def __init__(self,
                  action: int,
                  duration: float,
                  weight: float,
                  ) -> None:
-        self.action = action
-        self.duration = duration
-        self.weight = weight
+        self._action = action
+        self._duration = duration
+        self._weight = weight
+        self._distance = self._mean_speed = self._spent_calories = None
+
+    action = metric_input('action')
+    duration = metric_input('duration')
+    weight = metric_input('weight')
+
+    def reset_metrics(self) -> None:
+        """Сбросить посчитанные дистанцию, скорость и калории."""
+        self._distance = self._mean_speed = self._spent_calories = None
+
+    @property
+    def distance(self) -> float:
+        """Дистанция в км, считается один раз."""
+        if self._distance is None:
+            self._distance = self.get_distance()
+        return self._distance
+
+    @property
+    def mean_speed(self) -> float:
+        """Средняя скорость, считается один раз."""
+        if self._mean_speed is None:
+            self._mean_speed = self.get_mean_speed()
+        return self._mean_speed
+
+    @property
+    def spent_calories(self) -> float:
+        """Затраченные калории, считаются один раз."""
+        if self._spent_calories is None:
+            self._spent_calories = self.get_spent_calories()
+        return self._spent_calories
 
     def get_distance(self) -> float:
         """Получить дистанцию в км."""
@@ -40,7 +256,7 @@ class Training:
 
     def get_mean_speed(self) -> float:
         """Получить среднюю скорость движения."""
-        return self.get_distance() / self.duration
+        return self.distance / self.duration
 
     def get_spent_calories(self) -> float:
         """Получить количество затраченных калорий."""
@@ -50,28 +266,128 @@ class Training:
     def show_training_info(self) -> InfoMessage:
         """Вернуть информационное сообщение о выполненной тренировке."""
         return InfoMessage(self.__class__.__name__,
-                           self.duration, self.get_distance(),
-                           self.get_mean_speed(),
-                           self.get_spent_calories())
+                           self.duration, self.distance,
+                           self.mean_speed,
+                           self.spent_calories)
+
+    @classmethod
+    def get_batch_distance(cls, batch: Dict) -> 'numpy.ndarray':
+        """Получить дистанцию в км для колонок пачки тренировок."""
+        return batch['action'] * cls.LEN_STEP / cls.M_IN_KM
+
+    @classmethod
+    def get_batch_mean_speed(cls, batch: Dict) -> 'numpy.ndarray':
+        """Получить среднюю скорость для колонок пачки тренировок."""
+        return cls.get_batch_distance(batch) / batch['duration']
+
+    @classmethod
+    def get_batch_spent_calories(cls, batch: Dict) -> 'numpy.ndarray':
+        """Получить затраченные калории для колонок пачки тренировок."""
+        raise NotImplementedError('Определите get_batch_spent_calories в '
+                                  + cls.__name__)
+
+    @classmethod
+    def get_batch_metrics(cls, batch: Dict) -> Tuple:
+        """Вернуть дистанцию, скорость и калории для пачки тренировок."""
+        return (cls.get_batch_distance(batch),
+                cls.get_batch_mean_speed(batch),
+                cls.get_batch_spent_calories(batch))
+
+    @classmethod
+    def get_fixed_distance(cls, batch: Dict):
+        """Получить дистанцию в фиксированной точке."""
+        return fixed_div(fixed_mul(batch['action'], to_fixed(cls.LEN_STEP)),
+                         to_fixed(cls.M_IN_KM))
+
+    @classmethod
+    def get_fixed_mean_speed(cls, batch: Dict):
+        """Получить среднюю скорость в фиксированной точке."""
+        return fixed_div(cls.get_fixed_distance(batch), batch['duration'])
+
+    @classmethod
+    def get_fixed_spent_calories(cls, batch: Dict):
+        """Получить затраченные калории в фиксированной точке."""
+        raise NotImplementedError('Определите get_fixed_spent_calories в '
+                                  + cls.__name__)
+
+    @classmethod
+    def get_fixed_metrics(cls, batch: Dict) -> Tuple:
+        """Вернуть дистанцию, скорость и калории в фиксированной точке.
 
+        batch — значения датчиков, переведённые через to_fixed: целые
+        числа Python для одной тренировки или колонки int64 для пачки.
+        В обоих случаях выполняются одни и те же целочисленные операции.
+        """
+        return (cls.get_fixed_distance(batch),
+                cls.get_fixed_mean_speed(batch),
+                cls.get_fixed_spent_calories(batch))
 
-class Running(Training):
+    def show_fixed_training_info(self) -> InfoMessage:
+        """Вернуть сообщение о тренировке, посчитанное в целых числах.
+
+        Результат не зависит от порядка операций с float и совпадает
+        побитно с get_batch_metrics(..., fixed=True). Длительность
+        округляется до 1e-6 ч, и эта ошибка растёт вместе со скоростью.
+        Отличие от show_training_info: дистанция — до 1e-6, скорость —
+        до 1e-6 + speed * 1e-6 / duration, калории — до
+        1e-3 + calories * 1e-6 / duration (duration в часах).
+        Исключение — SportsWalking, если speed**2 / height ближе этой
+        ошибки к целому: округление вниз может сдвинуть калории на
+        0.029 * weight * duration * 60.
+
+        Колонки int64 вмещают величины по модулю до 2**62 / FIXED_SCALE
+        ** 2 (около 4.6e6) и их произведения до 4.6e12: с запасом для
+        action до MAX_ACTION и скорости до 1e6 км/ч. За пределами
+        диапазона get_batch_metrics(..., fixed=True) поднимает
+        OverflowError для всей пачки, а расчёт одной тренировки на целых
+        Python продолжает работать.
+        """
+        batch = {name: to_fixed(getattr(self, name))
+                 for name in self.PARAMETERS}
+        distance, speed, calories = self.get_fixed_metrics(batch)
+        return InfoMessage(self.__class__.__name__, self.duration,
+                           distance / FIXED_SCALE, speed / FIXED_SCALE,
+                           calories / FIXED_SCALE)
+
+
+class Running(Training, code='RUN'):
     """Тренировка: бег."""
+    __slots__ = ()
     LEN_STEP: float = 0.65
     CALORIES_MEAN_SPEED_MULTIPLIER: int = 18
     CALORIES_MEAN_SPEED_SHIFT: int = 20
 
     def get_spent_calories(self) -> float:
         return ((self.CALORIES_MEAN_SPEED_MULTIPLIER
-                * self.get_mean_speed()
+                * self.mean_speed
                 - self.CALORIES_MEAN_SPEED_SHIFT)
                 * self.weight / self.M_IN_KM
                 * self.duration
                 * self.MINS_IN_HOUR)
 
+    @classmethod
+    def get_batch_spent_calories(cls, batch: Dict) -> 'numpy.ndarray':
+        return ((cls.CALORIES_MEAN_SPEED_MULTIPLIER
+                * cls.get_batch_mean_speed(batch)
+                - cls.CALORIES_MEAN_SPEED_SHIFT)
+                * batch['weight'] / cls.M_IN_KM
+                * batch['duration']
+                * cls.MINS_IN_HOUR)
+
+    @classmethod
+    def get_fixed_spent_calories(cls, batch: Dict):
+        shifted = (fixed_mul(to_fixed(cls.CALORIES_MEAN_SPEED_MULTIPLIER),
+                             cls.get_fixed_mean_speed(batch))
+                   - to_fixed(cls.CALORIES_MEAN_SPEED_SHIFT))
+        per_minute = fixed_div(fixed_mul(shifted, batch['weight']),
+                               to_fixed(cls.M_IN_KM))
+        return fixed_mul(fixed_mul(per_minute, batch['duration']),
+                         to_fixed(cls.MINS_IN_HOUR))
+
 
-class SportsWalking(Training):
+class SportsWalking(Training, code='WLK'):
     """Тренировка: спортивная ходьба."""
+    __slots__ = ('_height',)
     LEN_STEP: float = 0.65
     CALORIES_WEIGHT_COEFF: float = 0.035
     CALORIES_MEAN_SPEED_COEFF: float = 0.029
@@ -82,21 +398,46 @@ class SportsWalking(Training):
                  weight: float,
                  height: float) -> None:
         super().__init__(action, duration, weight)
-        self.height = height
+        self._height = height
+
+    height = metric_input('height')
 
     def get_spent_calories(self) -> float:
         return ((self.CALORIES_WEIGHT_COEFF
                 * self.weight
-                + (self.get_mean_speed()**2
+                + (self.mean_speed**2
                    // self.height)
                 * self.CALORIES_MEAN_SPEED_COEFF
                 * self.weight)
                 * self.duration
                 * self.MINS_IN_HOUR)
 
+    @classmethod
+    def get_batch_spent_calories(cls, batch: Dict) -> 'numpy.ndarray':
+        return ((cls.CALORIES_WEIGHT_COEFF
+                * batch['weight']
+                + (cls.get_batch_mean_speed(batch)**2
+                   // batch['height'])
+                * cls.CALORIES_MEAN_SPEED_COEFF
+                * batch['weight'])
+                * batch['duration']
+                * cls.MINS_IN_HOUR)
+
+    @classmethod
+    def get_fixed_spent_calories(cls, batch: Dict):
+        speed = cls.get_fixed_mean_speed(batch)
+        speed_steps = fixed_mul(speed, speed) // batch['height']
+        per_minute = (
+            fixed_mul(to_fixed(cls.CALORIES_WEIGHT_COEFF), batch['weight'])
+            + fixed_mul(speed_steps * to_fixed(cls.CALORIES_MEAN_SPEED_COEFF),
+                        batch['weight']))
+        return fixed_mul(fixed_mul(per_minute, batch['duration']),
+                         to_fixed(cls.MINS_IN_HOUR))
+
 
-class Swimming(Training):
+class Swimming(Training, code='SWM'):
     """Тренировка: плавание."""
+    __slots__ = ('_length_pool', '_count_pool')
     LEN_STEP: float = 1.38
     CALORIES_MEAN_SPEED_SHIFT: float = 1.1
     CALORIES_MEAN_SPEED_MULTIPLIER: int = 2
@@ -108,8 +449,11 @@ class Swimming(Training):
                  length_pool: float,
                  count_pool: float) -> None:
         super().__init__(action, duration, weight)
-        self.length_pool = length_pool
-        self.count_pool = count_pool
+        self._length_pool = length_pool
+        self._count_pool = count_pool
+
+    length_pool = metric_input('length_pool')
+    count_pool = metric_input('count_pool')
 
     def get_mean_speed(self) -> float:
         return (self.length_pool
@@ -118,23 +462,745 @@ class Swimming(Training):
                 / self.duration)
 
     def get_spent_calories(self) -> float:
-        return ((self.get_mean_speed()
+        return ((self.mean_speed
                 + self.CALORIES_MEAN_SPEED_SHIFT)
                 * self.CALORIES_MEAN_SPEED_MULTIPLIER
                 * self.weight)
 
+    @classmethod
+    def get_batch_mean_speed(cls, batch: Dict) -> 'numpy.ndarray':
+        return (batch['length_pool']
+                * batch['count_pool']
+                / cls.M_IN_KM
+                / batch['duration'])
+
+    @classmethod
+    def get_batch_spent_calories(cls, batch: Dict) -> 'numpy.ndarray':
+        return ((cls.get_batch_mean_speed(batch)
+                + cls.CALORIES_MEAN_SPEED_SHIFT)
+                * cls.CALORIES_MEAN_SPEED_MULTIPLIER
+                * batch['weight'])
+
+    @classmethod
+    def get_fixed_mean_speed(cls, batch: Dict):
+        length = fixed_div(fixed_mul(batch['length_pool'],
+                                     batch['count_pool']),
+                           to_fixed(cls.M_IN_KM))
+        return fixed_div(length, batch['duration'])
+
+    @classmethod
+    def get_fixed_spent_calories(cls, batch: Dict):
+        return fixed_mul(
+            fixed_mul(cls.get_fixed_mean_speed(batch)
+                      + to_fixed(cls.CALORIES_MEAN_SPEED_SHIFT),
+                      to_fixed(cls.CALORIES_MEAN_SPEED_MULTIPLIER)),
+            batch['weight'])
+
+
+def get_batch_metrics(workout_types,
+                      action,
+                      duration,
+                      weight,
+                      height=None,
+                      length_pool=None,
+                      count_pool=None,
+                      fixed: bool = False):
+    """Посчитать дистанцию, скорость и калории для пачки тренировок.
+
+    Принимает колонки одинаковой длины: коды тренировок ('RUN', 'WLK',
+    'SWM') и данные датчиков. Колонки height, length_pool и count_pool
+    нужны только тренировкам, которые их используют. Возвращает три
+    массива numpy: дистанцию, среднюю скорость и потраченные калории,
+    совпадающие с результатами get_distance, get_mean_speed и
+    get_spent_calories.
+
+    С fixed=True расчёт идёт в целых числах int64 (get_fixed_metrics)
+    и побитно совпадает с show_fixed_training_info.
+    """
+    import numpy as np
+
+    codes = np.asarray(workout_types)
+    columns = {
+        'action': action,
+        'duration': duration,
+        'weight': weight,
+        'height': height,
+        'length_pool': length_pool,
+        'count_pool': count_pool,
+    }
+    columns = {name: np.asarray(values, dtype=np.float64)
+               for name, values in columns.items() if values is not None}
+    if fixed:
+        columns = {name: np.rint(values * FIXED_SCALE).astype(np.int64)
+                   for name, values in columns.items()}
+
+    unknown = ~np.isin(codes, list(TRAININGS))
+    if unknown.any():
+        raise ValueError(f'Тренировки {codes[unknown][0]}у нас нет')
+
+    distance = np.empty(len(codes))
+    speed = np.empty(len(codes))
+    calories = np.empty(len(codes))
+    for code, training in TRAININGS.items():
+        rows = codes == code
+        if not rows.any():
+            continue
+        batch = {name: values[rows] for name, values in columns.items()}
+        try:
+            if fixed:
+                (distance[rows],
+                 speed[rows],
+                 calories[rows]) = (
+                    values / FIXED_SCALE
+                    for values in training.get_fixed_metrics(batch))
+            else:
+                (distance[rows],
+                 speed[rows],
+                 calories[rows]) = training.get_batch_metrics(batch)
+        except KeyError as error:
+            raise ValueError(f'Для тренировки {code} '
+                             f'нужна колонка {error.args[0]}') from error
+    return distance, speed, calories
+
 
 def read_package(workout_type: str, data: List) -> Training:
     """Прочитать данные полученные от датчиков."""
-    to_do = {
-        'RUN': Running,
-        'WLK': SportsWalking,
-        'SWM': Swimming
-    }
+    if workout_type not in TRAININGS:
+        raise ValueError(f'Тренировки {workout_type}у нас нет')
+    return TRAININGS[workout_type](*data)
+
 
-    if workout_type not in to_do:
+def read_packages(workout_type: str, rows: Iterable[List]) -> List[Training]:
+    """Прочитать пачку пакетов одного типа тренировки.
+
+    Число и типы значений проверяются один раз для всей пачки, после
+    чего объекты создаются без проверок.
+    """
+    if workout_type not in TRAININGS:
         raise ValueError(f'Тренировки {workout_type}у нас нет')
-    return to_do[workout_type](*data)
+    training = TRAININGS[workout_type]
+    rows = list(rows)
+    if {len(row) for row in rows} - {training.ARITY}:
+        raise ValueError(f'Тренировке {workout_type} нужно '
+                         f'{training.ARITY} значений')
+    if not all(isinstance(value, Real) for row in rows for value in row):
+        raise TypeError(f'Данные тренировки {workout_type} должны '
+                        'быть числами')
+    return [training(*row) for row in rows]
+
+
+MAX_ACTION = 10 ** 6
+NUMBER_TYPES = frozenset((int, float))
+ANOMALY_RULES = (
+    ('zero_duration', 'duration', lambda value: value <= 0),
+    ('negative_weight', 'weight', lambda value: value < 0),
+    ('action_range', 'action',
+     lambda value: (value < 0) | (value > MAX_ACTION)),
+    ('zero_height', 'height', lambda value: value <= 0),
+)
+MALFORMED = object()
+PARSE_ERRORS = (ValueError, TypeError, KeyError, RecursionError)
+
+
+@dataclass(slots=True)
+class Anomaly:
+    """Пакет, отложенный в карантин до расчёта тренировки.
+
+    У записи, которую не удалось разобрать (причина 'malformed'),
+    workout_type равен None, а data — её исходная строка.
+    """
+    index: int
+    workout_type: Optional[str]
+    data: Union[List, str]
+    reason: str
+
+
+def get_anomaly_rules() -> Dict[str, List[Tuple]]:
+    """Вернуть для кодов тренировок правила с позициями их полей."""
+    return {
+        code: [(reason, training.PARAMETERS.index(name), is_bad)
+               for reason, name, is_bad in ANOMALY_RULES
+               if name in training.PARAMETERS]
+        for code, training in TRAININGS.items()
+    }
+
+
+def check_packet(workout_type: str, data: List,
+                 rules: Optional[Dict] = None) -> Optional[str]:
+    """Вернуть код причины, по которой пакет нельзя считать, или None.
+
+    Код тренировки должен быть строкой из TRAININGS, данные — списком
+    или кортежем конечных чисел. Затем правила ANOMALY_RULES
+    проверяются по порядку, возвращается первая сработавшая причина.
+    """
+    if rules is None:
+        rules = get_anomaly_rules()
+    if not isinstance(workout_type, str) or workout_type not in rules:
+        return 'unknown_type'
+    if (not isinstance(data, (list, tuple))
+            or len(data) != TRAININGS[workout_type].ARITY):
+        return 'arity'
+    if not (NUMBER_TYPES.issuperset(map(type, data))
+            or all(isinstance(value, Real) for value in data)):
+        return 'not_number'
+    try:
+        if not all(map(isfinite, data)):
+            return 'not_finite'
+    except OverflowError:
+        return 'not_finite'
+    for reason, position, is_bad in rules[workout_type]:
+        if is_bad(data[position]):
+            return reason
+    return None
+
+
+def filter_packets(packets: Iterable[Tuple],
+                   quarantine: List[Anomaly]) -> Iterator[Tuple]:
+    """Пропустить дальше только пакеты, которые можно посчитать.
+
+    Остальные добавляются в quarantine с номером пакета в потоке
+    и кодом причины. Нераспознанные записи из read_packets
+    с keep_malformed=True откладываются с причиной 'malformed'.
+    """
+    rules = get_anomaly_rules()
+    for index, (workout_type, data) in enumerate(packets):
+        if workout_type is MALFORMED:
+            quarantine.append(Anomaly(index, None, data, 'malformed'))
+            continue
+        reason = check_packet(workout_type, data, rules)
+        if reason is None:
+            yield workout_type, data
+        else:
+            quarantine.append(Anomaly(index, workout_type, data, reason))
+
+
+def check_batch(workout_types, columns: Dict) -> 'numpy.ndarray':
+    """Проверить пачку колонок и вернуть массив кодов причин.
+
+    Для пакетов без отклонений код — пустая строка. Правило применяется
+    только к строкам тренировок, у которых есть его поле. NaN и
+    бесконечности в нужных тренировке полях дают код 'not_finite'.
+    """
+    import numpy as np
+
+    codes = np.asarray(workout_types)
+    reasons = np.full(len(codes), '', dtype='U16')
+    for reason, name, is_bad in reversed(ANOMALY_RULES):
+        users = [code for code, training in TRAININGS.items()
+                 if name in training.PARAMETERS]
+        if columns.get(name) is None or not users:
+            continue
+        bad = is_bad(np.asarray(columns[name]))
+        if bad.any():
+            reasons[bad & np.isin(codes, users)] = reason
+    for name, values in columns.items():
+        if values is None:
+            continue
+        bad = ~np.isfinite(np.asarray(values, dtype=np.float64))
+        if bad.any():
+            users = [code for code, training in TRAININGS.items()
+                     if name in training.PARAMETERS]
+            reasons[bad & np.isin(codes, users)] = 'not_finite'
+    reasons[~np.isin(codes, list(TRAININGS))] = 'unknown_type'
+    return reasons
+
+
+def filter_batch(workout_types, columns: Dict) -> Tuple:
+    """Отделить от пачки колонок пакеты с отклонениями.
+
+    Возвращает коды тренировок, словарь колонок для get_batch_metrics
+    и список Anomaly. Если отклонений нет, колонки возвращаются без
+    копирования.
+    """
+    import numpy as np
+
+    codes = np.asarray(workout_types)
+    reasons = check_batch(codes, columns)
+    valid = reasons == ''
+    if valid.all():
+        return codes, columns, []
+    columns = {name: np.asarray(values)
+               for name, values in columns.items() if values is not None}
+    anomalies = []
+    for index in np.flatnonzero(~valid):
+        workout_type = str(codes[index])
+        parameters = getattr(TRAININGS.get(workout_type), 'PARAMETERS', ())
+        anomalies.append(Anomaly(
+            int(index), workout_type,
+            [columns[name][index].item() for name in parameters
+             if name in columns],
+            str(reasons[index])))
+    return codes[valid], {name: values[valid]
+                          for name, values in columns.items()}, anomalies
+
+
+class TrainingSeries:
+    """Долгая тренировка как ряд отсчётов датчика.
+
+    Каждый отсчёт длится sample_seconds и хранит число действий
+    (шагов или гребков) и, для плавания, число пройденных бассейнов.
+    Отсчёты лежат в массивах array, суммы скользящего окна и текущего
+    круга обновляются при добавлении за O(1). Метрики считаются теми же
+    классами тренировок, что и для целых пакетов.
+    """
+    SECONDS_IN_HOUR: int = 3600
+
+    def __init__(self,
+                 workout_type: str,
+                 window: int = 60,
+                 sample_seconds: float = 1,
+                 **parameters: float) -> None:
+        if workout_type not in TRAININGS:
+            raise ValueError(f'Тренировки {workout_type}у нас нет')
+        if window < 1:
+            raise ValueError('Окно должно быть не меньше одного отсчёта')
+        self.training = TRAININGS[workout_type]
+        self.window = window
+        self.sample_seconds = sample_seconds
+        self.parameters = parameters
+        self.actions = array('q')
+        self.pools = array('q')
+        self.window_totals = [0, 0]
+        self.lap_start = 0
+        self.lap_totals = [0, 0]
+        self.laps: List[Tuple] = []
+
+    def __len__(self) -> int:
+        return len(self.actions)
+
+    def append(self, action: int, count_pool: int = 0) -> None:
+        """Добавить отсчёт и сдвинуть скользящее окно."""
+        self.actions.append(action)
+        self.pools.append(count_pool)
+        self.window_totals[0] += action
+        self.window_totals[1] += count_pool
+        self.lap_totals[0] += action
+        self.lap_totals[1] += count_pool
+        leaving = len(self.actions) - self.window - 1
+        if leaving >= 0:
+            self.window_totals[0] -= self.actions[leaving]
+            self.window_totals[1] -= self.pools[leaving]
+
+    def extend(self, actions: Iterable[int],
+               count_pools: Optional[Iterable[int]] = None) -> None:
+        """Добавить несколько отсчётов."""
+        if count_pools is None:
+            count_pools = repeat(0)
+        for action, count_pool in zip(actions, count_pools):
+            self.append(action, count_pool)
+
+    def get_info(self, action: int, count_pool: int,
+                 samples: int) -> InfoMessage:
+        """Посчитать сообщение для отрезка из samples отсчётов."""
+        values = dict(self.parameters,
+                      action=action,
+                      count_pool=count_pool,
+                      duration=(samples * self.sample_seconds
+                                / self.SECONDS_IN_HOUR))
+        return self.training(
+            *(values[name] for name in self.training.PARAMETERS)
+        ).show_training_info()
+
+    def get_window_info(self) -> InfoMessage:
+        """Вернуть метрики последних window отсчётов."""
+        if not self.actions:
+            raise ValueError('В тренировке ещё нет отсчётов')
+        return self.get_info(*self.window_totals,
+                             min(self.window, len(self.actions)))
+
+    def mark_lap(self) -> InfoMessage:
+        """Закончить текущий круг и вернуть его метрики."""
+        samples = len(self.actions) - self.lap_start
+        if not samples:
+            raise ValueError('В круге нет отсчётов')
+        info = self.get_info(*self.lap_totals, samples)
+        self.laps.append((self.lap_start, len(self.actions), info))
+        self.lap_start = len(self.actions)
+        self.lap_totals = [0, 0]
+        return info
+
+    def iter_window_infos(self) -> Iterator[InfoMessage]:
+        """Вернуть кривую скользящего окна: метрики на каждый отсчёт.
+
+        Ряд проходится один раз, суммы окна сдвигаются на отсчёт.
+        """
+        action = count_pool = 0
+        for index, (new_action, new_pool) in enumerate(
+                zip(self.actions, self.pools)):
+            action += new_action
+            count_pool += new_pool
+            if index >= self.window:
+                action -= self.actions[index - self.window]
+                count_pool -= self.pools[index - self.window]
+            yield self.get_info(action, count_pool,
+                                min(self.window, index + 1))
+
+
+@dataclass
+class CacheInfo:
+    """Статистика кеша сообщений о тренировках."""
+    hits: int
+    misses: int
+    evictions: int
+    maxsize: int
+    size: int
+
+
+class InfoMessageCache:
+    """Кеш InfoMessage для повторяющихся пакетов с вытеснением LRU.
+
+    Ключ — (workout_type, tuple(data)). Сообщения хранятся неизменяемыми
+    кортежами полей, и для повторного пакета собирается новый
+    InfoMessage без пересчёта: изменение полученного сообщения не
+    портит кеш для следующих обращений. Кеш можно
+    использовать из нескольких потоков: словарь и счётчики меняются под
+    блокировкой, а сам расчёт при промахе идёт без неё.
+    """
+
+    def __init__(self, maxsize: int = 4096) -> None:
+        if maxsize < 1:
+            raise ValueError('Размер кеша должен быть больше нуля')
+        self.maxsize = maxsize
+        self.messages: OrderedDict = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+        self.lock = Lock()
+
+    def get_info(self, workout_type: str, data: List) -> InfoMessage:
+        """Вернуть сообщение для пакета, посчитав его при промахе."""
+        key = (workout_type, tuple(data))
+        with self.lock:
+            row = self.messages.get(key)
+            if row is not None:
+                self.hits += 1
+                self.messages.move_to_end(key)
+                return InfoMessage(*row)
+            self.misses += 1
+        row = get_message_fields(
+            read_package(workout_type, data).show_training_info())
+        with self.lock:
+            row = self.messages.setdefault(key, row)
+            self.messages.move_to_end(key)
+            if len(self.messages) > self.maxsize:
+                self.messages.popitem(last=False)
+                self.evictions += 1
+        return InfoMessage(*row)
+
+    def cache_info(self) -> CacheInfo:
+        """Вернуть статистику попаданий, промахов и вытеснений."""
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             self.maxsize, len(self.messages))
+
+    def clear(self) -> None:
+        """Очистить кеш и статистику."""
+        with self.lock:
+            self.messages.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+@dataclass(slots=True)
+class TrainingTotals:
+    """Суммы по тренировкам за период."""
+    count: int = 0
+    duration: float = 0.0
+    distance: float = 0.0
+    calories: float = 0.0
+
+    def add(self, message: InfoMessage) -> None:
+        """Учесть одну тренировку."""
+        self.count += 1
+        self.duration += message.duration
+        self.distance += message.distance
+        self.calories += message.calories
+
+    def copy(self) -> 'TrainingTotals':
+        """Вернуть независимую копию сумм."""
+        return TrainingTotals(self.count, self.duration,
+                              self.distance, self.calories)
+
+    def merge(self, other: 'TrainingTotals') -> None:
+        """Прибавить суммы, посчитанные в другом месте."""
+        self.count += other.count
+        self.duration += other.duration
+        self.distance += other.distance
+        self.calories += other.calories
+
+
+class TrainingAggregator:
+    """Накопительные итоги тренировок по пользователям.
+
+    Каждое сообщение сразу добавляется в итоги за день, ISO-неделю и
+    месяц — отдельно по своему типу тренировки и по всем типам вместе,
+    поэтому запрос итогов не пересчитывает исходные пакеты. Итоги
+    меняются под блокировкой, агрегатор можно наполнять из потоков.
+    """
+    PERIODS: Tuple = ('day', 'week', 'month')
+
+    def __init__(self) -> None:
+        self.totals: Dict[Tuple, TrainingTotals] = {}
+        self.lock = Lock()
+
+    @staticmethod
+    def get_period_key(period: str, day: 'date') -> Tuple:
+        """Вернуть ключ периода, в который попадает день."""
+        if period == 'day':
+            return day.year, day.month, day.day
+        if period == 'week':
+            year, week, _ = day.isocalendar()
+            return year, week
+        if period == 'month':
+            return day.year, day.month
+        raise ValueError(f'Периода {period} у нас нет')
+
+    def add(self, user: str, message: InfoMessage, day: 'date') -> None:
+        """Учесть тренировку пользователя, прошедшую в день day."""
+        keys = [(user, period, self.get_period_key(period, day),
+                 training_type)
+                for period in self.PERIODS
+                for training_type in (message.training_type, None)]
+        with self.lock:
+            for key in keys:
+                totals = self.totals.get(key)
+                if totals is None:
+                    totals = self.totals[key] = TrainingTotals()
+                totals.add(message)
+
+    def extend(self, records: Iterable[Tuple]) -> None:
+        """Учесть поток записей (user, message, day)."""
+        for user, message, day in records:
+            self.add(user, message, day)
+
+    def merge(self, other: 'TrainingAggregator') -> None:
+        """Добавить итоги, накопленные другим агрегатором."""
+        with other.lock:
+            items = [(key, totals.copy())
+                     for key, totals in other.totals.items()]
+        with self.lock:
+            for key, totals in items:
+                if key in self.totals:
+                    self.totals[key].merge(totals)
+                else:
+                    self.totals[key] = totals
+
+    def get_totals(self,
+                   user: str,
+                   period: str,
+                   day: 'date',
+                   training_type: Optional[str] = None) -> TrainingTotals:
+        """Вернуть итоги пользователя за период, в который попадает day.
+
+        Без training_type возвращаются итоги по всем типам тренировок.
+        """
+        key = (user, period, self.get_period_key(period, day),
+               training_type)
+        with self.lock:
+            return self.totals.get(key, TrainingTotals()).copy()
+
+
+class TopMessages:
+    """Потоковый отбор k лучших тренировок по полю InfoMessage.
+
+    Для каждого типа тренировки хранится куча из не больше k записей,
+    поэтому память не зависит от длины потока. Отборы из разных
+    процессов складываются через merge.
+    """
+
+    def __init__(self, k: int = 100, field_name: str = 'calories') -> None:
+        if k < 1:
+            raise ValueError('k должно быть больше нуля')
+        self.k = k
+        self.field_name = field_name
+        self.get_value = attrgetter(field_name)
+        self.heaps: Dict[str, List[Tuple]] = {}
+        self.added = 0
+
+    def add(self, message: InfoMessage) -> None:
+        """Учесть одно сообщение."""
+        heap = self.heaps.setdefault(message.training_type, [])
+        self.added += 1
+        entry = (self.get_value(message), self.added, message)
+        if len(heap) < self.k:
+            heappush(heap, entry)
+        elif entry[0] > heap[0][0]:
+            heappushpop(heap, entry)
+
+    def extend(self, messages: Iterable[InfoMessage]) -> None:
+        """Учесть несколько сообщений."""
+        for message in messages:
+            self.add(message)
+
+    def merge(self, other: 'TopMessages') -> None:
+        """Добавить записи, отобранные другим экземпляром."""
+        if (other.k, other.field_name) != (self.k, self.field_name):
+            raise ValueError('Складывать можно только отборы '
+                             'с одинаковыми k и полем')
+        for heap in other.heaps.values():
+            for _, _, message in heap:
+                self.add(message)
+
+    def get_top(self, training_type: Optional[str] = None
+                ) -> List[InfoMessage]:
+        """Вернуть до k сообщений по убыванию поля.
+
+        Без training_type отбор идёт по всем типам тренировок.
+        """
+        if training_type is None:
+            entries = chain.from_iterable(self.heaps.values())
+        else:
+            entries = self.heaps.get(training_type, [])
+        return [message for _, _, message in nlargest(self.k, entries)]
+
+
+class QuantileSketch:
+    """Приближённые квантили потока чисел с относительной погрешностью.
+
+    Значения раскладываются по логарифмическим корзинам (как в
+    DDSketch): любой квантиль возвращается с относительной ошибкой не
+    больше relative_accuracy. Если корзин становится больше
+    max_buckets, самые маленькие по модулю сливаются, и точность
+    теряется только для нижних квантилей. Наброски с одинаковыми
+    параметрами складываются через merge. NaN и бесконечности в
+    квантили не попадают и считаются отдельно в non_finite.
+    """
+    MIN_VALUE: float = 1e-9
+
+    def __init__(self,
+                 relative_accuracy: float = 0.01,
+                 max_buckets: int = 2048) -> None:
+        if not 0 < relative_accuracy < 1:
+            raise ValueError('Точность должна быть между 0 и 1')
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = log(self.gamma)
+        self.positive: Dict[int, int] = {}
+        self.negative: Dict[int, int] = {}
+        self.zero = self.count = self.non_finite = 0
+
+    def add(self, value: float) -> None:
+        """Учесть одно значение."""
+        if not isfinite(value):
+            self.non_finite += 1
+            return
+        if value > self.MIN_VALUE:
+            buckets = self.positive
+        elif value < -self.MIN_VALUE:
+            buckets, value = self.negative, -value
+        else:
+            self.zero += 1
+            self.count += 1
+            return
+        index = ceil(log(value) / self.log_gamma)
+        buckets[index] = buckets.get(index, 0) + 1
+        self.count += 1
+        if len(buckets) > self.max_buckets:
+            self.collapse(buckets)
+
+    def extend(self, values: Iterable[float]) -> None:
+        """Учесть несколько значений.
+
+        Конечные положительные значения раскладываются во внутреннем
+        цикле без вызова add, остальные передаются в add.
+        """
+        positive = self.positive
+        min_value = self.MIN_VALUE
+        log_gamma = self.log_gamma
+        added = 0
+        for value in values:
+            if min_value < value < inf:
+                index = ceil(log(value) / log_gamma)
+                positive[index] = positive.get(index, 0) + 1
+                added += 1
+            else:
+                self.add(value)
+        self.count += added
+        self.collapse(positive)
+
+    def collapse(self, buckets: Dict[int, int]) -> None:
+        """Слить самые маленькие корзины, чтобы их осталось max_buckets."""
+        indexes = sorted(buckets)
+        extra = len(indexes) - self.max_buckets
+        if extra <= 0:
+            return
+        target = indexes[extra]
+        for index in indexes[:extra]:
+            buckets[target] += buckets.pop(index)
+
+    def merge(self, other: 'QuantileSketch') -> None:
+        """Добавить значения, учтённые другим наброском."""
+        if other.gamma != self.gamma:
+            raise ValueError('Складывать можно только наброски '
+                             'с одинаковой точностью')
+        for buckets, others in ((self.positive, other.positive),
+                                (self.negative, other.negative)):
+            for index, number in others.items():
+                buckets[index] = buckets.get(index, 0) + number
+            self.collapse(buckets)
+        self.zero += other.zero
+        self.count += other.count
+        self.non_finite += other.non_finite
+
+    def get_value(self, index: int) -> float:
+        """Вернуть представителя корзины index."""
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def quantile(self, q: float) -> float:
+        """Вернуть приближённый квантиль q (от 0 до 1)."""
+        if not 0 <= q <= 1:
+            raise ValueError('Квантиль должен быть от 0 до 1')
+        if not self.count:
+            raise ValueError('В наброске нет значений')
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self.get_value(index)
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self.get_value(index)
+        return self.get_value(max(self.positive))
+
+
+class MessageQuantiles:
+    """Наброски квантилей для числовых полей InfoMessage."""
+    FIELDS: Tuple = ('speed', 'distance', 'calories')
+
+    def __init__(self,
+                 relative_accuracy: float = 0.01,
+                 max_buckets: int = 2048,
+                 chunk_size: int = 4096) -> None:
+        self.sketches = {name: QuantileSketch(relative_accuracy, max_buckets)
+                         for name in self.FIELDS}
+        self.get_values = attrgetter(*self.FIELDS)
+        self.chunk_size = chunk_size
+
+    def add(self, message: InfoMessage) -> None:
+        """Учесть одно сообщение."""
+        for sketch, value in zip(self.sketches.values(),
+                                 self.get_values(message)):
+            sketch.add(value)
+
+    def extend(self, messages: Iterable[InfoMessage]) -> None:
+        """Учесть несколько сообщений пачками по chunk_size."""
+        for chunk in iter_chunks(messages, self.chunk_size):
+            for name, sketch in self.sketches.items():
+                sketch.extend(map(attrgetter(name), chunk))
+
+    def merge(self, other: 'MessageQuantiles') -> None:
+        """Добавить наброски, собранные другим экземпляром."""
+        for name, sketch in self.sketches.items():
+            sketch.merge(other.sketches[name])
+
+    def quantile(self, field_name: str, q: float) -> float:
+        """Вернуть приближённый квантиль q поля field_name."""
+        if field_name not in self.sketches:
+            raise ValueError(f'Поля {field_name} нет в набросках')
+        return self.sketches[field_name].quantile(q)
 
 
 def main(training: Training) -> None:
@@ -142,13 +1208,1185 @@ def main(training: Training) -> None:
     print(training.show_training_info().get_message())
 
 
+def get_messages(packets: List[Tuple]) -> List[str]:
+    """Вернуть тексты сообщений для списка пакетов (workout_type, data)."""
+    return [read_package(workout_type, data).show_training_info()
+            .get_message()
+            for workout_type, data in packets]
+
+
+def get_messages_parallel(packets: Iterable[Tuple],
+                          chunk_size: int = 10000,
+                          max_workers: Optional[int] = None,
+                          min_parallel: int = 50000) -> Iterator[str]:
+    """Посчитать сообщения для пакетов в пуле процессов.
+
+    Воркерам уходят пачки сырых кортежей (workout_type, data), а не
+    объекты Training, и обратно приходят готовые строки. Порядок
+    сообщений совпадает с порядком пакетов, а в работе одновременно
+    находится не больше двух пачек на процесс. Если пакетов меньше
+    min_parallel, пул не запускается и всё считается в текущем процессе.
+    """
+    chunks = iter_chunks(
+        ((workout_type, tuple(data)) for workout_type, data in packets),
+        chunk_size)
+    head = []
+    for chunk in chunks:
+        head.append(chunk)
+        if len(head) * chunk_size >= min_parallel:
+            break
+    else:
+        for chunk in head:
+            yield from get_messages(chunk)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    max_workers = max_workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers) as executor:
+        for messages in map_ordered(executor, get_messages,
+                                    chain(head, chunks), 2 * max_workers):
+            yield from messages
+
+
+def get_messages_threaded(packets: Iterable[Tuple],
+                          chunk_size: int = 1000,
+                          max_workers: Optional[int] = None) -> Iterator[str]:
+    """Посчитать сообщения для пакетов в пуле потоков.
+
+    Пачки пакетов считаются в потоках без общего изменяемого состояния,
+    поэтому на сборках CPython без GIL они выполняются параллельно.
+    Порядок сообщений совпадает с порядком пакетов.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    max_workers = max_workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers) as executor:
+        for messages in map_ordered(executor, get_messages,
+                                    iter_chunks(packets, chunk_size),
+                                    2 * max_workers):
+            yield from messages
+
+
+def map_ordered(executor, function, items: Iterable,
+                window: int) -> Iterator:
+    """Выполнить function над items в executor, сохраняя порядок.
+
+    Одновременно в работе не больше window задач.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) > window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def parse_number(value: str) -> float:
+    """Преобразовать строковое значение датчика в число."""
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def parse_packet(line: str) -> Tuple:
+    """Разобрать JSON-запись пакета в пару (workout_type, data)."""
+    import json
+
+    packet = json.loads(line)
+    if isinstance(packet, dict):
+        return packet['workout_type'], packet['data']
+    workout_type, data = packet
+    return workout_type, data
+
+
+def parse_row(row: List[str]) -> Tuple:
+    """Разобрать CSV-строку пакета в пару (workout_type, data)."""
+    return row[0], [parse_number(value) for value in row[1:]]
+
+
+def parse_record(parse: Callable, record: Union[str, List[str]],
+                 keep_malformed: bool) -> Tuple:
+    """Разобрать запись, а при ошибке вернуть (MALFORMED, её строку)."""
+    try:
+        return parse(record)
+    except PARSE_ERRORS:
+        if not keep_malformed:
+            raise
+    if isinstance(record, str):
+        return MALFORMED, record.rstrip('\r\n')
+    return MALFORMED, ','.join(record)
+
+
+def read_packets(source: TextIO,
+                 fmt: str = 'json',
+                 keep_malformed: bool = False) -> Iterator[Tuple]:
+    """Построчно прочитать пакеты (workout_type, data) из потока.
+
+    Формат 'json' — одна JSON-запись на строку: объект с ключами
+    workout_type и data или список из двух элементов. Формат 'csv' —
+    код тренировки и значения датчиков через запятую.
+
+    Запись, которую не удалось разобрать, останавливает чтение. С
+    keep_malformed=True вместо неё отдаётся пара (MALFORMED, строка),
+    чтобы filter_packets отложил её, не прерывая поток.
+    """
+    if fmt == 'csv':
+        import csv
+
+        for row in csv.reader(source):
+            if row:
+                yield parse_record(parse_row, row, keep_malformed)
+        return
+    if fmt != 'json':
+        raise ValueError(f'Формата {fmt} у нас нет')
+    for line in source:
+        if line.strip():
+            yield parse_record(parse_packet, line, keep_malformed)
+
+
+def iter_chunks(items: Iterable, size: int) -> Iterator[List]:
+    """Разбить поток на списки длиной не больше size."""
+    if size < 1:
+        raise ValueError('Размер пачки должен быть больше нуля')
+    iterator = iter(items)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def process_stream(source: TextIO,
+                   output: TextIO,
+                   fmt: str = 'json',
+                   chunk_size: int = 1000,
+                   cache: Optional[InfoMessageCache] = None,
+                   quarantine: Optional[List[Anomaly]] = None) -> int:
+    """Обработать поток пакетов пачками и записать сообщения в output.
+
+    В памяти одновременно держится не больше chunk_size пакетов.
+    Если передан cache, повторяющиеся пакеты берутся из него. Если
+    передан список quarantine, пакеты с отклонениями откладываются
+    в него (filter_packets). Возвращает количество обработанных пакетов.
+    """
+    packets = read_packets(source, fmt, keep_malformed=quarantine is not None)
+    if quarantine is not None:
+        packets = filter_packets(packets, quarantine)
+    count = 0
+    for chunk in iter_chunks(packets, chunk_size):
+        if cache is None:
+            messages = (read_package(workout_type, data).show_training_info()
+                        for workout_type, data in chunk)
+        else:
+            messages = (cache.get_info(workout_type, data)
+                        for workout_type, data in chunk)
+        output.write(format_messages(messages))
+        count += len(chunk)
+    return count
+
+
+SHARD_MANIFEST = 'manifest.json'
+
+
+def write_atomic(path: str, text: str) -> None:
+    """Записать файл целиком: через временный файл и os.replace."""
+    temporary = path + '.tmp'
+    with open(temporary, 'w', encoding='utf-8') as output:
+        output.write(text)
+    os.replace(temporary, path)
+
+
+def process_shard(lines: List[str], fmt: str, path: str) -> int:
+    """Посчитать пакеты шарда и записать сообщения в path.
+
+    Возвращает число пакетов в шарде.
+    """
+    from io import StringIO
+
+    source = StringIO(''.join(lines))
+    messages = [read_package(workout_type, data).show_training_info()
+                for workout_type, data in read_packets(source, fmt)]
+    write_atomic(path, format_messages(messages))
+    return len(messages)
+
+
+class ShardedJob:
+    """Пакетная обработка файла по шардам с контрольными точками.
+
+    Вход делится на шарды по shard_size строк. Результат каждого шарда
+    пишется в свой файл в output_dir, а номер шарда — в manifest.json.
+    При перезапуске готовые шарды из манифеста пропускаются. Файлы
+    шардов и манифест заменяются атомарно, поэтому прерванный запуск
+    оставляет только целые файлы. Манифест хранит размер и время
+    изменения входа: если файл перезаписали или дописали, перезапуск
+    отказывается продолжать.
+    """
+
+    def __init__(self,
+                 source: str,
+                 output_dir: str,
+                 fmt: str = 'json',
+                 shard_size: int = 100000,
+                 workers: int = 0) -> None:
+        self.source = source
+        self.output_dir = output_dir
+        self.fmt = fmt
+        self.shard_size = shard_size
+        self.workers = workers
+        self.manifest_path = os.path.join(output_dir, SHARD_MANIFEST)
+        self.manifest = self.load_manifest()
+
+    def load_manifest(self) -> Dict:
+        """Прочитать манифест или создать новый."""
+        import json
+
+        stat = os.stat(self.source)
+        settings = {'source': os.path.abspath(self.source),
+                    'source_size': stat.st_size,
+                    'source_mtime_ns': stat.st_mtime_ns,
+                    'format': self.fmt,
+                    'shard_size': self.shard_size}
+        if not os.path.exists(self.manifest_path):
+            return dict(settings, shards={})
+        with open(self.manifest_path, encoding='utf-8') as source:
+            manifest = json.load(source)
+        for key, value in settings.items():
+            if manifest.get(key) != value:
+                raise ValueError(f'Манифест {self.manifest_path} записан '
+                                 f'для другого {key}: {manifest.get(key)}')
+        return manifest
+
+    def get_shard_path(self, index: int) -> str:
+        """Вернуть путь к файлу результатов шарда."""
+        return os.path.join(self.output_dir, f'shard-{index:05d}.txt')
+
+    def complete(self, index: int, count: int) -> None:
+        """Отметить шард готовым и сохранить манифест."""
+        import json
+
+        self.manifest['shards'][str(index)] = count
+        write_atomic(self.manifest_path,
+                     json.dumps(self.manifest, ensure_ascii=False, indent=2))
+
+    def iter_pending(self) -> Iterator[Tuple]:
+        """Вернуть неготовые шарды парами (номер, строки)."""
+        with open(self.source, encoding='utf-8', newline='') as source:
+            for index, lines in enumerate(iter_chunks(source,
+                                                      self.shard_size)):
+                if str(index) not in self.manifest['shards']:
+                    yield index, lines
+
+    def run(self) -> int:
+        """Обработать неготовые шарды и вернуть их число."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self.workers:
+            return self.run_parallel()
+        done = 0
+        for index, lines in self.iter_pending():
+            self.complete(index, process_shard(
+                lines, self.fmt, self.get_shard_path(index)))
+            done += 1
+        return done
+
+    def run_parallel(self) -> int:
+        """Обработать неготовые шарды в пуле процессов."""
+        from concurrent.futures import ProcessPoolExecutor
+
+        done = 0
+        with ProcessPoolExecutor(self.workers) as executor:
+            pending = deque()
+            for index, lines in self.iter_pending():
+                pending.append((index, executor.submit(
+                    process_shard, lines, self.fmt,
+                    self.get_shard_path(index))))
+                if len(pending) > 2 * self.workers:
+                    index, future = pending.popleft()
+                    self.complete(index, future.result())
+                    done += 1
+            while pending:
+                index, future = pending.popleft()
+                self.complete(index, future.result())
+                done += 1
+        return done
+
+    def iter_messages(self) -> Iterator[str]:
+        """Вернуть строки результатов готовых шардов по порядку."""
+        for index in sorted(map(int, self.manifest['shards'])):
+            with open(self.get_shard_path(index), encoding='utf-8') as shard:
+                yield from shard
+
+
+LATENCY_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5,
+                   1e-4, 1e-3, 1e-2, 1e-1, 1.0)
+
+
+@dataclass(slots=True)
+class StageStats:
+    """Число вызовов, суммарное время и гистограмма задержек этапа."""
+    count: int = 0
+    total: float = 0.0
+    buckets: List[int] = field(
+        default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+
+    def add(self, seconds: float) -> None:
+        """Учесть один вызов длительностью seconds."""
+        self.count += 1
+        self.total += seconds
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+
+class Instrumentation:
+    """Замеры этапов обработки тренировок по типам тренировок.
+
+    Пока замеры не включены через enable() или with, код модуля не
+    меняется и ничего не стоит. enable() подменяет read_package, методы
+    get_* тренировок, InfoMessage.get_message и пакетные format_messages
+    и write_messages обёртками с таймером, disable() возвращает
+    исходные. Время этапов включает вложенные вызовы: get_spent_calories
+    учитывает и расчёт скорости, а пакетное форматирование — расчёт
+    сообщений, если они переданы генератором. Пакетные этапы
+    учитываются по вызову с типом тренировки 'ALL'. Замеры
+    можно собирать из нескольких потоков, но включать и выключать их
+    нужно, пока другие потоки не обрабатывают пакеты.
+    """
+    METHODS: Tuple = ('get_distance', 'get_mean_speed', 'get_spent_calories')
+
+    def __init__(self) -> None:
+        self.stats: Dict[Tuple, StageStats] = {}
+        self.originals: List[Tuple] = []
+        self.lock = Lock()
+
+    def record(self, stage: str, training_type: str, seconds: float) -> None:
+        """Учесть вызов этапа stage для типа тренировки."""
+        key = (stage, training_type)
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = StageStats()
+            stats.add(seconds)
+
+    def patch(self, owner, name: str, wrapper) -> None:
+        """Подменить атрибут owner.name, запомнив исходный."""
+        original = getattr(owner, name)
+        self.originals.append((owner, name, original))
+        setattr(owner, name, wrapper(original))
+
+    def time_method(self, stage: str, get_type, argument: str = 'self'):
+        """Вернуть обёртку функции, замеряющую этап stage.
+
+        Тип тренировки получается get_type из первого аргумента,
+        переданного позиционно или по имени argument.
+        """
+        record = self.record
+
+        def wrapper(method):
+            @wraps(method)
+            def timed(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    key = args[0] if args else kwargs.get(argument)
+                    record(stage, get_type(key), perf_counter() - start)
+            return timed
+        return wrapper
+
+    def enable(self) -> None:
+        """Включить замеры."""
+        if self.originals:
+            return
+        module = sys.modules[__name__]
+        self.patch(module, 'read_package', self.time_method(
+            'read_package',
+            lambda code: getattr(TRAININGS.get(code), '__name__', code),
+            'workout_type'))
+        for name in ('format_messages', 'write_messages'):
+            self.patch(module, name, self.time_method(
+                name, lambda messages: 'ALL', 'messages'))
+        for training in (Training, *TRAININGS.values()):
+            for name in self.METHODS:
+                if name in training.__dict__:
+                    self.patch(training, name, self.time_method(
+                        name, lambda obj: type(obj).__name__))
+        self.patch(InfoMessage, 'get_message', self.time_method(
+            'get_message', attrgetter('training_type')))
+
+    def disable(self) -> None:
+        """Выключить замеры и вернуть исходные функции."""
+        while self.originals:
+            owner, name, original = self.originals.pop()
+            setattr(owner, name, original)
+
+    def __enter__(self) -> 'Instrumentation':
+        self.enable()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.disable()
+
+    def to_json(self) -> List[Dict]:
+        """Вернуть замеры списком словарей для JSON."""
+        return [{'stage': stage,
+                 'training_type': training_type,
+                 'count': stats.count,
+                 'total_seconds': stats.total,
+                 'buckets': dict(zip(map(str, LATENCY_BUCKETS + ('+Inf',)),
+                                     stats.buckets))}
+                for (stage, training_type), stats in self.stats.items()]
+
+    def to_prometheus(self) -> str:
+        """Вернуть замеры в текстовом формате Prometheus."""
+        lines = [
+            '# HELP homework_stage_seconds Время этапов обработки тренировок.',
+            '# TYPE homework_stage_seconds histogram',
+        ]
+        for (stage, training_type), stats in self.stats.items():
+            labels = f'stage="{stage}",training_type="{training_type}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',),
+                                    stats.buckets):
+                cumulative += count
+                lines.append(f'homework_stage_seconds_bucket'
+                             f'{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'homework_stage_seconds_sum{{{labels}}} '
+                         f'{stats.total!r}')
+            lines.append(f'homework_stage_seconds_count{{{labels}}} '
+                         f'{stats.count}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: str, fmt: str = 'json') -> None:
+        """Записать замеры в файл в формате 'json' или 'prometheus'."""
+        if fmt == 'json':
+            import json
+
+            text = json.dumps(self.to_json(), ensure_ascii=False, indent=2)
+        elif fmt == 'prometheus':
+            text = self.to_prometheus()
+        else:
+            raise ValueError(f'Формата {fmt} у нас нет')
+        with open(path, 'w', encoding='utf-8') as output:
+            output.write(text)
+
+
+PACKETS_MAGIC = b'FTPK'
+MESSAGES_MAGIC = b'FTMS'
+COLUMNS_VERSION = 1
+COLUMNS_HEADER = struct.Struct('<4sHHHQ')
+PACKET_COLUMNS = ('action', 'duration', 'weight',
+                  'height', 'length_pool', 'count_pool')
+MESSAGE_COLUMNS = ('duration', 'distance', 'speed', 'calories')
+
+
+def pad_to_8(size: int) -> int:
+    """Вернуть число байт выравнивания size до кратного 8."""
+    return -size % 8
+
+
+def write_columns(path: str,
+                  magic: bytes,
+                  type_names: List[str],
+                  type_index: array,
+                  columns: Dict[str, array]) -> None:
+    """Записать колонки в бинарный файл.
+
+    Заголовок: магия, версия, число названий типов, число колонок и
+    записей, затем названия с длиной в байте. Дальше колонка индексов
+    типов (uint8) и колонки double (little-endian), каждая с выравниванием
+    по 8 байт, чтобы файл можно было читать через mmap без копирования.
+    """
+    if sys.byteorder != 'little':
+        raise ValueError('Колоночный формат поддерживает только '
+                         'little-endian')
+    header = bytearray(COLUMNS_HEADER.pack(
+        magic, COLUMNS_VERSION, len(type_names), len(columns),
+        len(type_index)))
+    for name in chain(type_names, columns):
+        encoded = name.encode()
+        header += bytes((len(encoded),)) + encoded
+    header += bytes(pad_to_8(len(header)))
+    with open(path, 'wb') as output:
+        output.write(header)
+        output.write(type_index)
+        output.write(bytes(pad_to_8(len(type_index))))
+        for values in columns.values():
+            output.write(values)
+
+
+class ColumnFile:
+    """Колоночный файл, открытый через mmap.
+
+    type_index и columns — memoryview поверх файла, данные в объекты
+    Python не копируются. Закрывается через close() или with.
+    """
+
+    def __init__(self, path: str) -> None:
+        import mmap
+
+        with open(path, 'rb') as source:
+            self.map = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self.map)
+        try:
+            type_count, count, names, offset = self.read_header(buffer, path)
+        except ValueError:
+            buffer.release()
+            self.map.close()
+            raise
+        self.type_names = names[:type_count]
+        self.type_index = buffer[offset:offset + count]
+        offset += count + pad_to_8(count)
+        self.columns = {}
+        for name in names[type_count:]:
+            self.columns[name] = buffer[offset:offset + 8 * count].cast('d')
+            offset += 8 * count
+        self.buffer = buffer
+
+    def read_header(self, buffer: memoryview, path: str) -> Tuple:
+        """Разобрать заголовок и проверить, что файл не обрезан.
+
+        Возвращает число названий типов, число записей, все названия
+        и смещение колонки индексов типов.
+        """
+        try:
+            (self.magic, version, type_count,
+             column_count, count) = COLUMNS_HEADER.unpack_from(buffer)
+        except struct.error:
+            self.magic = version = None
+        if (self.magic not in (PACKETS_MAGIC, MESSAGES_MAGIC)
+                or version != COLUMNS_VERSION):
+            raise ValueError(f'Файл {path} не в колоночном формате')
+        offset = COLUMNS_HEADER.size
+        names = []
+        for _ in range(type_count + column_count):
+            if offset >= len(buffer):
+                raise ValueError(f'Файл {path} обрезан')
+            size = buffer[offset]
+            if offset + 1 + size > len(buffer):
+                raise ValueError(f'Файл {path} обрезан')
+            try:
+                names.append(
+                    bytes(buffer[offset + 1:offset + 1 + size]).decode())
+            except UnicodeDecodeError as error:
+                raise ValueError(f'Файл {path} повреждён') from error
+            offset += 1 + size
+        offset += pad_to_8(offset)
+        end = offset + count + pad_to_8(count) + 8 * count * column_count
+        if end > len(buffer):
+            raise ValueError(f'Файл {path} обрезан')
+        return type_count, count, names, offset
+
+    def __len__(self) -> int:
+        return len(self.type_index)
+
+    def __enter__(self) -> 'ColumnFile':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Освободить представления и закрыть mmap."""
+        for column in self.columns.values():
+            column.release()
+        self.type_index.release()
+        self.buffer.release()
+        self.map.close()
+
+    def get_workout_types(self) -> List[str]:
+        """Вернуть коды или названия тренировок по записям."""
+        return [self.type_names[index] for index in self.type_index]
+
+    def check_magic(self, magic: bytes) -> None:
+        """Проверить, что в файле пакеты или сообщения, как ожидается."""
+        if self.magic != magic:
+            raise ValueError(f'В файле нет данных {magic.decode()}')
+
+    def iter_packets(self) -> Iterator[Tuple]:
+        """Вернуть пакеты (workout_type, data) для read_package."""
+        self.check_magic(PACKETS_MAGIC)
+        for index, type_index in enumerate(self.type_index):
+            workout_type = self.type_names[type_index]
+            yield workout_type, [
+                self.columns[name][index]
+                for name in TRAININGS[workout_type].PARAMETERS
+            ]
+
+    def iter_messages(self) -> Iterator[InfoMessage]:
+        """Вернуть сохранённые сообщения о тренировках."""
+        self.check_magic(MESSAGES_MAGIC)
+        for training_type, *values in zip(self.get_workout_types(),
+                                          *self.columns.values()):
+            yield InfoMessage(training_type, *values)
+
+    def get_batch_metrics(self) -> Tuple:
+        """Посчитать метрики пакетов файла через get_batch_metrics.
+
+        Коды тренировок собираются массивом numpy по колонке индексов,
+        колонки значений читаются прямо из mmap: объектов Python на
+        запись не создаётся.
+        """
+        import numpy as np
+
+        self.check_magic(PACKETS_MAGIC)
+        codes = np.asarray(self.type_names)[
+            np.frombuffer(self.type_index, np.uint8)]
+        return get_batch_metrics(codes, **self.columns)
+
+
+def save_packets(path: str, packets: Iterable[Tuple]) -> int:
+    """Сохранить пакеты (workout_type, data) в колоночный файл.
+
+    Возвращает число сохранённых пакетов.
+    """
+    type_names: List[str] = []
+    type_index = array('B')
+    columns = {name: array('d') for name in PACKET_COLUMNS}
+    for workout_type, data in packets:
+        if workout_type not in TRAININGS:
+            raise ValueError(f'Тренировки {workout_type}у нас нет')
+        parameters = TRAININGS[workout_type].PARAMETERS
+        if set(parameters) - set(PACKET_COLUMNS):
+            raise ValueError(f'Поля тренировки {workout_type} нельзя '
+                             'сохранить в колоночный файл')
+        if len(data) != len(parameters):
+            raise ValueError(f'Тренировке {workout_type} нужно '
+                             f'{len(parameters)} значений')
+        if workout_type not in type_names:
+            type_names.append(workout_type)
+        type_index.append(type_names.index(workout_type))
+        values = dict(zip(parameters, data))
+        for name, column in columns.items():
+            column.append(values.get(name, 0.0))
+    write_columns(path, PACKETS_MAGIC, type_names, type_index, columns)
+    return len(type_index)
+
+
+def save_messages(path: str, messages: Iterable[InfoMessage]) -> int:
+    """Сохранить поля InfoMessage в колоночный файл.
+
+    Возвращает число сохранённых сообщений.
+    """
+    if not isinstance(messages, InfoMessageArray):
+        messages = InfoMessageArray(messages)
+    write_columns(path, MESSAGES_MAGIC, messages.training_types,
+                  messages.type_index,
+                  {name: getattr(messages, name) for name in MESSAGE_COLUMNS})
+    return len(messages)
+
+
+FRAME = struct.Struct('<2s3sxI5dI')
+FRAME_BODY_SIZE = FRAME.size - 4
+FRAME_MARKER = b'FT'
+
+
+@dataclass(slots=True)
+class FrameError:
+    """Испорченный или обрезанный кадр в буфере датчиков."""
+    offset: int
+    reason: str
+
+
+def get_frame_layouts() -> Dict[bytes, Tuple]:
+    """Вернуть для кодов тренировок в кадре индексы их полей."""
+    return {
+        code.encode(): (code, [PACKET_COLUMNS.index(name)
+                               for name in training.PARAMETERS])
+        for code, training in TRAININGS.items()
+        if set(training.PARAMETERS) <= set(PACKET_COLUMNS)
+    }
+
+
+def encode_frame(workout_type: str, data: List) -> bytes:
+    """Упаковать пакет в двоичный кадр датчика.
+
+    Кадр: маркер FT, код тренировки (3 байта ASCII), байт выравнивания,
+    action (uint32), duration, weight, height, length_pool, count_pool
+    (double) и CRC32 предыдущих байт кадра (uint32), всё little-endian.
+    Неиспользуемые поля равны нулю.
+    """
+    from zlib import crc32
+
+    if workout_type.encode() not in get_frame_layouts():
+        raise ValueError(f'Тренировку {workout_type} нельзя '
+                         'передать кадром')
+    values = dict(zip(TRAININGS[workout_type].PARAMETERS, data))
+    frame = bytearray(FRAME.pack(
+        FRAME_MARKER, workout_type.encode(),
+        *(values.get(name, 0) for name in PACKET_COLUMNS), 0))
+    struct.pack_into('<I', frame, FRAME_BODY_SIZE,
+                     crc32(frame[:FRAME_BODY_SIZE]))
+    return bytes(frame)
+
+
+def check_frame(view: memoryview, offset: int,
+                layouts: Dict[bytes, Tuple]) -> Optional[str]:
+    """Вернуть причину, по которой кадр с offset нельзя разобрать, или None.
+
+    Кадр должен целиком помещаться в буфер, начинаться с маркера,
+    совпадать с контрольной суммой и нести известный код тренировки.
+    """
+    from zlib import crc32
+
+    if offset + FRAME.size > len(view):
+        return 'обрезанный кадр'
+    if view[offset:offset + len(FRAME_MARKER)] != FRAME_MARKER:
+        return 'неверный маркер кадра'
+    body = view[offset:offset + FRAME_BODY_SIZE]
+    if crc32(body) != FRAME.unpack_from(view, offset)[-1]:
+        return 'неверная контрольная сумма'
+    code = bytes(view[offset + 2:offset + 5])
+    if code not in layouts:
+        return f'неизвестный код тренировки {code!r}'
+    return None
+
+
+def find_frame_marker(view: memoryview, start: int,
+                      window: int = 1 << 16) -> int:
+    """Найти маркер кадра в view начиная с start или вернуть -1.
+
+    Поиск идёт окнами по window байт, весь буфер не копируется.
+    """
+    overlap = len(FRAME_MARKER) - 1
+    while start < len(view):
+        found = bytes(view[start:start + window + overlap]).find(FRAME_MARKER)
+        if found >= 0:
+            return start + found
+        start += window
+    return -1
+
+
+def is_intact_frame(view: memoryview, offset: int) -> bool:
+    """Проверить, что с offset лежит целый кадр с верной суммой."""
+    from zlib import crc32
+
+    return (offset + FRAME.size <= len(view)
+            and view[offset:offset + len(FRAME_MARKER)] == FRAME_MARKER
+            and crc32(view[offset:offset + FRAME_BODY_SIZE])
+            == FRAME.unpack_from(view, offset)[-1])
+
+
+def find_next_frame(view: memoryview, start: int) -> int:
+    """Вернуть смещение следующего целого кадра или маркера в хвосте.
+
+    Маркеры FT внутри данных испорченного кадра, за которыми нет целого
+    кадра, пропускаются. Если маркеров больше нет, возвращается длина
+    буфера.
+    """
+    offset = find_frame_marker(view, start)
+    while (0 <= offset and offset + FRAME.size <= len(view)
+           and not is_intact_frame(view, offset)):
+        offset = find_frame_marker(view, offset + 1)
+    return len(view) if offset < 0 else offset
+
+
+def iter_frame_offsets(buffer: bytes,
+                       errors: List[FrameError]) -> Iterator[int]:
+    """Вернуть смещения исправных кадров в буфере.
+
+    На каждый испорченный кадр в errors добавляется одна запись с его
+    смещением. Если после кадра с неверной суммой на границе кадра
+    снова стоит маркер, разбор продолжается с неё, иначе — со
+    следующего целого кадра (find_next_frame). Кадр, внутри которого
+    начинается следующий целый кадр, считается обрезанным. Кадр с
+    неизвестным кодом, но верной контрольной суммой пропускается
+    целиком.
+    """
+    from zlib import crc32
+
+    view = memoryview(buffer)
+    layouts = get_frame_layouts()
+    get_head = struct.Struct('<2s3s').unpack_from
+    get_crc = struct.Struct('<I').unpack_from
+    offset, end = 0, len(view)
+    while offset < end:
+        body_end = offset + FRAME_BODY_SIZE
+        if body_end + 4 <= end:
+            marker, code = get_head(view, offset)
+        else:
+            marker = code = None
+        if (marker == FRAME_MARKER and code in layouts
+                and crc32(view[offset:body_end])
+                == get_crc(view, body_end)[0]):
+            yield offset
+            offset += FRAME.size
+            continue
+        reason = check_frame(view, offset, layouts)
+        if reason.startswith('неизвестный код'):
+            errors.append(FrameError(offset, reason))
+            offset += FRAME.size
+            continue
+        following = find_next_frame(view, offset + 1)
+        boundary = offset + FRAME.size
+        if reason == 'неверная контрольная сумма':
+            if following < boundary:
+                reason = 'обрезанный кадр'
+            elif view[boundary:boundary + 2] == FRAME_MARKER:
+                following = boundary
+        errors.append(FrameError(offset, reason))
+        offset = following
+
+
+def iter_frames(buffer: bytes,
+                errors: List[FrameError]) -> Iterator[Tuple]:
+    """Разобрать кадры из буфера в пакеты (workout_type, data).
+
+    Испорченные кадры пропускаются, а их смещения и причины
+    добавляются в errors (iter_frame_offsets).
+    """
+    layouts = get_frame_layouts()
+    for offset in iter_frame_offsets(buffer, errors):
+        marker, code, *values = FRAME.unpack_from(buffer, offset)
+        workout_type, fields = layouts[code]
+        yield workout_type, [values[field] for field in fields]
+
+
+def parse_frames(buffer: bytes) -> Tuple:
+    """Разобрать буфер кадров в колонки для get_batch_metrics.
+
+    Кадры читаются numpy-представлением поверх буфера, без объекта
+    Python на каждое поле. Если буфер не делится на кадры ровно,
+    исправные кадры находятся через iter_frame_offsets и копируются.
+    Возвращает коды тренировок, словарь колонок и список FrameError
+    для испорченных и обрезанных кадров.
+    """
+    import numpy as np
+    from zlib import crc32
+
+    dtype = np.dtype([('marker', 'S2'), ('code', 'S3'), ('pad', 'V1'),
+                      ('action', '<u4'), ('duration', '<f8'),
+                      ('weight', '<f8'), ('height', '<f8'),
+                      ('length_pool', '<f8'), ('count_pool', '<f8'),
+                      ('crc', '<u4')])
+    view = memoryview(buffer)
+    count = len(view) // dtype.itemsize
+    frames = np.frombuffer(buffer, dtype, count)
+    errors: List[FrameError] = []
+    if count * dtype.itemsize != len(view) or not (
+            (frames['marker'] == FRAME_MARKER).all()
+            and np.isin(frames['code'], list(get_frame_layouts())).all()
+            and (frames['crc'] == np.fromiter(
+                (crc32(view[offset:offset + FRAME_BODY_SIZE])
+                 for offset in range(0, len(view), dtype.itemsize)),
+                np.uint32, count)).all()):
+        frames = np.frombuffer(b''.join(
+            view[offset:offset + dtype.itemsize]
+            for offset in iter_frame_offsets(buffer, errors)), dtype)
+    columns = {name: frames[name] for name in PACKET_COLUMNS}
+    return frames['code'].astype('U3'), columns, errors
+
+
+class PacketServer:
+    """Asyncio-сервер, считающий тренировки для живых датчиков.
+
+    Клиенты присылают пакеты JSON-строками и получают в ответ текст
+    InfoMessage, по строке на пакет и в том же порядке. Пакеты всех
+    подключений считаются общими пачками до batch_size штук. У каждого
+    клиента не больше max_pending неотправленных ответов: медленный
+    клиент перестаёт читаться сам, не задерживая остальных.
+    """
+    OVERSIZED = object()
+
+    def __init__(self,
+                 batch_size: int = 1000,
+                 max_pending: int = 100,
+                 cache: Optional[InfoMessageCache] = None) -> None:
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.cache = cache
+        self.requests = None
+        self.batcher = None
+
+    def get_reply(self, line: bytes) -> str:
+        """Посчитать текст ответа для одной строки пакета."""
+        workout_type, data = parse_packet(line)
+        if self.cache is not None:
+            return self.cache.get_info(workout_type, data).get_message()
+        return read_package(workout_type, data).show_training_info(
+        ).get_message()
+
+    async def compute_batches(self) -> None:
+        """Считать накопившиеся пакеты всех клиентов пачками.
+
+        Ошибка любого пакета передаётся в его ответ: общая задача
+        расчёта не должна останавливаться из-за одного клиента.
+        """
+        import asyncio
+
+        while True:
+            batch = [await self.requests.get()]
+            while len(batch) < self.batch_size and not self.requests.empty():
+                batch.append(self.requests.get_nowait())
+            for line, reply in batch:
+                if reply.cancelled():
+                    continue
+                try:
+                    reply.set_result(self.get_reply(line))
+                except Exception as error:
+                    reply.set_exception(error)
+            await asyncio.sleep(0)
+
+    async def send_replies(self, replies, writer) -> None:
+        """Отправлять клиенту готовые ответы в порядке пакетов.
+
+        Если клиент отключился, ответы дочитываются из очереди без
+        отправки, чтобы чтение пакетов не зависло на полной очереди.
+        """
+        connected = True
+        while True:
+            reply = await replies.get()
+            if reply is None:
+                return
+            try:
+                text = await reply
+            except Exception as error:
+                text = f'Ошибка: {error!r}'
+            if not connected:
+                continue
+            try:
+                writer.write(text.encode() + b'\n')
+                await writer.drain()
+            except ConnectionError:
+                connected = False
+
+    @staticmethod
+    async def read_line(reader):
+        """Прочитать строку пакета.
+
+        Возвращает строку, None в конце передачи или OVERSIZED, если
+        строка длиннее лимита StreamReader: такая строка дочитывается
+        до перевода строки и отбрасывается.
+        """
+        import asyncio
+
+        oversized = False
+        while True:
+            try:
+                line = await reader.readuntil(b'\n')
+            except asyncio.IncompleteReadError as error:
+                line = error.partial
+                if not line and not oversized:
+                    return None
+            except asyncio.LimitOverrunError as error:
+                await reader.readexactly(error.consumed)
+                oversized = True
+                continue
+            return PacketServer.OVERSIZED if oversized else line
+
+    async def handle_client(self, reader, writer) -> None:
+        """Читать пакеты клиента и ставить их в общую очередь.
+
+        На слишком длинную строку клиент получает ошибку в порядке
+        пакетов, а чтение продолжается со следующей строки.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        replies = asyncio.Queue(self.max_pending)
+        sender = asyncio.ensure_future(self.send_replies(replies, writer))
+        try:
+            while True:
+                line = await self.read_line(reader)
+                if line is None:
+                    break
+                reply = loop.create_future()
+                if line is self.OVERSIZED:
+                    reply.set_exception(
+                        ValueError('Строка пакета длиннее допустимой'))
+                    await replies.put(reply)
+                    continue
+                if not line.strip():
+                    continue
+                await replies.put(reply)
+                await self.requests.put((line, reply))
+            await replies.put(None)
+            await sender
+        except ConnectionError:
+            pass
+        finally:
+            sender.cancel()
+            writer.close()
+
+    async def start(self,
+                    host: str = '127.0.0.1',
+                    port: int = 0,
+                    path: Optional[str] = None):
+        """Запустить TCP-сервер или, если задан path, Unix-сокет."""
+        import asyncio
+
+        self.requests = asyncio.Queue(self.batch_size)
+        self.batcher = asyncio.ensure_future(self.compute_batches())
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle_client, path)
+        return await asyncio.start_server(self.handle_client, host, port)
+
+    def close(self) -> None:
+        """Остановить задачу расчёта пачек."""
+        if self.batcher is not None:
+            self.batcher.cancel()
+            self.batcher = None
+
+    async def serve_forever(self, *args, **kwargs) -> None:
+        """Запустить сервер и обслуживать клиентов до остановки."""
+        server = await self.start(*args, **kwargs)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.close()
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    """Разобрать аргументы командной строки."""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Пакетная обработка данных фитнес-трекера.')
+    parser.add_argument(
+        'input', nargs='?',
+        help="файл пакетов или '-' для stdin; без него обрабатываются "
+             'демонстрационные пакеты')
+    parser.add_argument(
+        '-f', '--input-format', choices=('json', 'csv', 'frames', 'columns'),
+        help='формат входа; по умолчанию определяется по расширению')
+    parser.add_argument('-o', '--output', default='-',
+                        help="файл результатов или '-' для stdout")
+    parser.add_argument('-t', '--output-format', default='text',
+                        choices=('text', 'json', 'columns'))
+    parser.add_argument('--types', nargs='+', metavar='CODE',
+                        help='обрабатывать только эти коды тренировок')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--quarantine', metavar='PATH',
+                        help='откладывать пакеты с отклонениями в файл '
+                             'JSON-строк вместо остановки на ошибке')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='число процессов для расчёта; 0 — без пула')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='запустить сервер для датчиков на TCP-порту')
+    parser.add_argument('--socket', metavar='PATH',
+                        help='запустить сервер для датчиков на Unix-сокете')
+    args = parser.parse_args(argv)
+    if args.input_format is None and args.input is not None:
+        extension = os.path.splitext(args.input)[1]
+        args.input_format = {'.csv': 'csv', '.bin': 'frames',
+                             '.col': 'columns'}.get(extension, 'json')
+    if args.output_format == 'columns' and args.output == '-':
+        parser.error('для --output-format columns нужен файл --output')
+    if args.workers and args.output_format != 'text':
+        parser.error('--workers работает только с --output-format text')
+    return args
+
+
+def open_packets(args, stack) -> Iterator[Tuple]:
+    """Открыть вход командной строки и вернуть поток пакетов."""
+    if args.input_format == 'columns':
+        return stack.enter_context(ColumnFile(args.input)).iter_packets()
+    if args.input_format == 'frames':
+        if args.input == '-':
+            buffer = sys.stdin.buffer.read()
+        else:
+            source = stack.enter_context(open(args.input, 'rb'))
+            buffer = source.read()
+        errors: List[FrameError] = []
+        stack.callback(report_frame_errors, errors)
+        return iter_frames(buffer, errors)
+    if args.input == '-':
+        source = sys.stdin
+    else:
+        source = stack.enter_context(
+            open(args.input, encoding='utf-8', newline=''))
+    return read_packets(source, args.input_format,
+                        keep_malformed=bool(args.quarantine))
+
+
+def write_anomalies(path: str, anomalies: List[Anomaly]) -> None:
+    """Записать отложенные пакеты в файл JSON-строк."""
+    import json
+
+    with open(path, 'w', encoding='utf-8') as output:
+        for anomaly in anomalies:
+            output.write(json.dumps({
+                'index': anomaly.index,
+                'workout_type': anomaly.workout_type,
+                'data': anomaly.data,
+                'reason': anomaly.reason,
+            }, ensure_ascii=False) + '\n')
+
+
+def report_frame_errors(errors: List[FrameError]) -> None:
+    """Вывести в stderr испорченные кадры."""
+    for error in errors:
+        print(f'Кадр {error.offset}: {error.reason}', file=sys.stderr)
+
+
+def write_output(args, packets: Iterable[Tuple], output: TextIO) -> None:
+    """Посчитать пакеты и записать результаты в выбранном формате."""
+    if args.workers:
+        texts = get_messages_parallel(packets, args.chunk_size, args.workers)
+        for chunk in iter_chunks(texts, args.chunk_size):
+            output.write('\n'.join(chunk) + '\n')
+        return
+    messages = (read_package(workout_type, data).show_training_info()
+                for workout_type, data in packets)
+    if args.output_format == 'columns':
+        save_messages(args.output, messages)
+    elif args.output_format == 'json':
+        import json
+
+        names = ('training_type', 'duration', 'distance', 'speed',
+                 'calories')
+        for chunk in iter_chunks(messages, args.chunk_size):
+            output.write(''.join(
+                json.dumps(dict(zip(names, get_message_fields(message))),
+                           ensure_ascii=False) + '\n'
+                for message in chunk))
+    else:
+        write_messages(messages, output, args.chunk_size)
+
+
+def cli(argv: Optional[List[str]] = None) -> None:
+    """Точка входа командной строки.
+
+    Тяжёлые модули (argparse, asyncio, concurrent.futures, numpy)
+    импортируются только в тех режимах, которым они нужны.
+    """
+    args = parse_args(argv)
+    if args.serve is not None or args.socket is not None:
+        import asyncio
+
+        server = PacketServer(args.chunk_size)
+        asyncio.run(server.serve_forever(port=args.serve or 0,
+                                         path=args.socket))
+        return
+    if args.input is None:
+        packages = [
+            ('SWM', [720, 1, 80, 25, 40]),
+            ('RUN', [15000, 1, 75]),
+            ('WLK', [9000, 1, 75, 180]),
+        ]
+
+        for workout_type, data in packages:
+            training = read_package(workout_type, data)
+            main(training)
+        return
+
+    from contextlib import ExitStack
+
+    with ExitStack() as stack:
+        packets = open_packets(args, stack)
+        if args.quarantine:
+            anomalies: List[Anomaly] = []
+            stack.callback(write_anomalies, args.quarantine, anomalies)
+            packets = filter_packets(packets, anomalies)
+        if args.types:
+            packets = (packet for packet in packets
+                       if packet[0] in args.types)
+        output = sys.stdout
+        if args.output != '-' and args.output_format != 'columns':
+            output = stack.enter_context(
+                open(args.output, 'w', encoding='utf-8'))
+        write_output(args, packets, output)
+
+
 if __name__ == '__main__':
-    packages = [
-        ('SWM', [720, 1, 80, 25, 40]),
-        ('RUN', [15000, 1, 75]),
-        ('WLK', [9000, 1, 75, 180]),
-    ]
-
-    for workout_type, data in packages:
-        training = read_package(workout_type, data)
-        main(training)
+    cli()
@@ -1,8 +1,11 @@
+import os
 import re
+import struct
+import zlib
 import pytest
 import types
 import inspect
-from conftest import Capturing
+from conftest import BASE_DIR, Capturing
 
 try:
     import homework
@@ -363,3 +366,1123 @@ def test_main_output(input_data, expected):
     assert get_message_output == expected, (
         'Метод `main` должен печатать результат в консоль.\n'
     )
+
+
+@pytest.mark.parametrize('packages', [
+    [
+        ('SWM', [720, 1, 80, 25, 40]),
+        ('RUN', [15000, 1, 75]),
+        ('WLK', [9000, 1, 75, 180]),
+    ],
+    [
+        ('RUN', [1206, 12, 6]),
+        ('WLK', [420, 4, 20, 42]),
+        ('SWM', [1206, 12, 6, 12, 6]),
+        ('RUN', [420, 4, 20]),
+        ('WLK', [1206, 12, 6, 12]),
+    ],
+])
+def test_get_batch_metrics(packages):
+    np = pytest.importorskip('numpy')
+    columns = {'height': [], 'length_pool': [], 'count_pool': []}
+    for workout_type, data in packages:
+        columns['height'].append(data[3] if workout_type == 'WLK' else 0)
+        columns['length_pool'].append(
+            data[3] if workout_type == 'SWM' else 0)
+        columns['count_pool'].append(data[4] if workout_type == 'SWM' else 0)
+    distance, speed, calories = homework.get_batch_metrics(
+        [workout_type for workout_type, _ in packages],
+        [data[0] for _, data in packages],
+        [data[1] for _, data in packages],
+        [data[2] for _, data in packages],
+        **columns
+    )
+    for index, (workout_type, data) in enumerate(packages):
+        info = homework.read_package(workout_type, data).show_training_info()
+        assert (distance[index], speed[index], calories[index]) == (
+            info.distance, info.speed, info.calories
+        ), (
+            'Функция `get_batch_metrics` должна возвращать те же значения, '
+            'что и `show_training_info`.'
+        )
+    assert isinstance(calories, np.ndarray), (
+        'Функция `get_batch_metrics` должна возвращать массивы numpy.'
+    )
+
+
+def test_get_batch_metrics_unknown_type():
+    pytest.importorskip('numpy')
+    with pytest.raises(ValueError):
+        homework.get_batch_metrics(['RUN', 'BOX'], [1, 2], [1, 1], [1, 1])
+    with pytest.raises(ValueError):
+        homework.get_batch_metrics(['WLK'], [9000], [1], [75])
+
+
+@pytest.mark.parametrize('fmt, text', [
+    ('json',
+     '{"workout_type": "SWM", "data": [720, 1, 80, 25, 40]}\n'
+     '\n'
+     '["RUN", [15000, 1, 75]]\n'
+     '["WLK", [9000, 1, 75, 180]]\n'),
+    ('csv',
+     'SWM,720,1,80,25,40\n'
+     'RUN,15000,1,75\n'
+     'WLK,9000,1.0,75,180\n'),
+])
+def test_process_stream(fmt, text):
+    from io import StringIO
+    packages = [
+        ('SWM', [720, 1, 80, 25, 40]),
+        ('RUN', [15000, 1, 75]),
+        ('WLK', [9000, 1, 75, 180]),
+    ]
+    expected = [
+        homework.read_package(*package).show_training_info().get_message()
+        for package in packages
+    ]
+    output = StringIO()
+    count = homework.process_stream(StringIO(text), output, fmt, chunk_size=2)
+    assert count == 3, (
+        'Функция `process_stream` должна возвращать число пакетов.'
+    )
+    assert output.getvalue().splitlines() == expected, (
+        'Функция `process_stream` должна записывать сообщения '
+        'в том же порядке и виде, что и `main`.'
+    )
+
+
+def test_iter_chunks_is_lazy():
+    def packets():
+        yield from range(5)
+        raise AssertionError('Пачки должны читаться из потока по мере нужды')
+
+    chunks = homework.iter_chunks(packets(), 2)
+    assert next(chunks) == [0, 1], (
+        'Функция `iter_chunks` должна отдавать пачки заданного размера.'
+    )
+    assert next(chunks) == [2, 3]
+
+
+@pytest.mark.parametrize('min_parallel', [10 ** 6, 1])
+def test_get_messages_parallel(min_parallel):
+    packages = [
+        ('SWM', [720, 1, 80, 25, 40]),
+        ('RUN', [15000, 1, 75]),
+        ('WLK', [9000, 1, 75, 180]),
+        ('RUN', [1206, 12, 6]),
+    ] * 5
+    expected = [
+        homework.read_package(*package).show_training_info().get_message()
+        for package in packages
+    ]
+    result = list(homework.get_messages_parallel(
+        packages, chunk_size=3, max_workers=2, min_parallel=min_parallel
+    ))
+    assert result == expected, (
+        'Функция `get_messages_parallel` должна возвращать сообщения '
+        'в порядке пакетов.'
+    )
+
+
+def test_InfoMessage_slots():
+    info_message = homework.InfoMessage('Running', 1, 9.75, 9.75, 699.75)
+    assert not hasattr(info_message, '__dict__'), (
+        'У `InfoMessage` должны быть слоты вместо `__dict__`.'
+    )
+    for training in (homework.Running(15000, 1, 75),
+                     homework.SportsWalking(9000, 1, 75, 180),
+                     homework.Swimming(720, 1, 80, 25, 40)):
+        assert not training.__dict__, (
+            'Поля тренировки должны храниться в слотах.'
+        )
+
+
+def test_InfoMessageArray():
+    packages = [
+        ('SWM', [720, 1, 80, 25, 40]),
+        ('RUN', [15000, 1, 75]),
+        ('WLK', [9000, 1, 75, 180]),
+        ('RUN', [1206, 12, 6]),
+    ]
+    messages = [homework.read_package(*package).show_training_info()
+                for package in packages]
+    columns = homework.InfoMessageArray(messages)
+    assert len(columns) == len(messages)
+    assert list(columns) == messages, (
+        '`InfoMessageArray` должен возвращать те же сообщения, '
+        'что в него добавлены.'
+    )
+    assert columns[-1].get_message() == messages[-1].get_message()
+    assert columns.training_types == ['Swimming', 'Running', 'SportsWalking']
+
+
+def test_format_messages():
+    from io import StringIO
+    messages = [
+        homework.InfoMessage('Swimming', 1, 75, 1, 80),
+        homework.InfoMessage('Running', 12, 0.7839, 0.065325, -81.320328),
+        homework.InfoMessage('SportsWalking', 0.5, 2.0005, 1e9, 0.0625),
+    ]
+    expected = ''.join(message.get_message() + '\n' for message in messages)
+    assert homework.format_messages(messages) == expected, (
+        'Функция `format_messages` должна давать тот же текст, '
+        'что и `get_message`.'
+    )
+    assert homework.format_messages(
+        homework.InfoMessageArray(messages)) == expected
+    output = StringIO()
+    homework.write_messages(messages, output, chunk_size=2)
+    assert output.getvalue() == expected, (
+        'Функция `write_messages` должна записывать тот же текст, '
+        'что и `get_message`.'
+    )
+
+
+def test_training_registry(monkeypatch):
+    monkeypatch.setattr(homework, 'TRAININGS', dict(homework.TRAININGS))
+
+    class Cycling(homework.Training, code='CYC'):
+        LEN_STEP = 5.0
+
+        def get_spent_calories(self):
+            return self.get_mean_speed() * self.weight
+
+    assert homework.TRAININGS['CYC'] is Cycling, (
+        'Подкласс `Training` с параметром `code` должен '
+        'регистрироваться в `TRAININGS`.'
+    )
+    training = homework.read_package('CYC', [2000, 2, 70])
+    assert training.show_training_info().distance == 10.0
+    with pytest.raises(ValueError):
+        class Bike(homework.Training, code='CYC'):
+            pass
+
+
+def test_read_packages():
+    rows = [[15000, 1, 75], [1206, 12, 6]]
+    trainings = homework.read_packages('RUN', rows)
+    assert [training.get_spent_calories() for training in trainings] == [
+        homework.Running(*row).get_spent_calories() for row in rows
+    ], 'Функция `read_packages` должна создавать объекты тренировок.'
+    with pytest.raises(ValueError):
+        homework.read_packages('RUN', [[15000, 1, 75], [9000, 1, 75, 180]])
+    with pytest.raises(TypeError):
+        homework.read_packages('RUN', [[15000, '1', 75]])
+    with pytest.raises(ValueError):
+        homework.read_packages('BOX', [])
+
+
+def test_Training_metrics_are_cached():
+    calls = []
+
+    class CountedRunning(homework.Running):
+        def get_distance(self):
+            calls.append('get_distance')
+            return super().get_distance()
+
+        def get_mean_speed(self):
+            calls.append('get_mean_speed')
+            return super().get_mean_speed()
+
+        def get_spent_calories(self):
+            calls.append('get_spent_calories')
+            return super().get_spent_calories()
+
+    running = CountedRunning(9000, 1, 75)
+    running.show_training_info()
+    running.show_training_info()
+    assert sorted(calls) == [
+        'get_distance', 'get_mean_speed', 'get_spent_calories'
+    ], 'Каждая метрика тренировки должна считаться один раз.'
+
+
+@pytest.mark.parametrize('training, changes', [
+    (homework.Running(9000, 1, 75),
+     {'action': 1206, 'duration': 12, 'weight': 6}),
+    (homework.SportsWalking(9000, 1, 75, 180),
+     {'height': 42, 'weight': 20, 'duration': 4}),
+    (homework.Swimming(720, 1, 80, 25, 40),
+     {'length_pool': 42, 'count_pool': 4, 'weight': 20}),
+])
+def test_Training_metrics_reset(training, changes):
+    training.show_training_info()
+    for name, value in changes.items():
+        setattr(training, name, value)
+        fresh = type(training)(*(
+            getattr(training, parameter)
+            for parameter in inspect.signature(type(training)).parameters
+        ))
+        assert training.show_training_info() == (
+            fresh.show_training_info()
+        ), (
+            f'После изменения `{name}` метрики тренировки '
+            'нужно пересчитать.'
+        )
+    assert training.mean_speed == training.get_mean_speed()
+
+
+def test_InfoMessageCache():
+    cache = homework.InfoMessageCache(maxsize=2)
+    first = cache.get_info('RUN', [15000, 1, 75])
+    expected = homework.read_package(
+        'RUN', [15000, 1, 75]).show_training_info()
+    assert first == expected
+    first.calories = 0
+    assert cache.get_info('RUN', (15000, 1, 75)) == expected, (
+        'Изменение полученного сообщения не должно портить кеш.'
+    )
+    assert cache.cache_info().hits == 1, (
+        'Повторный пакет должен возвращаться из кеша.'
+    )
+    cache.get_info('SWM', [720, 1, 80, 25, 40])
+    cache.get_info('WLK', [9000, 1, 75, 180])
+    cache.get_info('SWM', [720, 1, 80, 25, 40])
+    info = cache.cache_info()
+    assert (info.hits, info.misses, info.evictions, info.size) == (
+        2, 3, 1, 2
+    ), 'Кеш должен считать попадания, промахи и вытеснения.'
+    cache.get_info('RUN', [15000, 1, 75])
+    assert cache.cache_info().misses == 4, (
+        'Самый давний пакет должен вытесняться из кеша.'
+    )
+
+
+def test_process_stream_with_cache():
+    from io import StringIO
+    text = '["RUN", [15000, 1, 75]]\n' * 3
+    cache = homework.InfoMessageCache()
+    output = StringIO()
+    homework.process_stream(StringIO(text), output, cache=cache)
+    message = homework.read_package(
+        'RUN', [15000, 1, 75]).show_training_info().get_message()
+    assert output.getvalue() == (message + '\n') * 3, (
+        'С кешем `process_stream` должна писать те же сообщения.'
+    )
+    assert cache.cache_info().hits == 2
+
+
+def test_PacketServer():
+    import asyncio
+    import json
+
+    packages = [
+        ('SWM', [720, 1, 80, 25, 40]),
+        ('RUN', [15000, 1, 75]),
+        ('WLK', [9000, 1, 75, 180]),
+    ]
+    expected = [
+        homework.read_package(*package).show_training_info().get_message()
+        for package in packages
+    ]
+
+    async def client(port, count):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        for index in range(count):
+            writer.write(json.dumps(packages[index % 3]).encode() + b'\n')
+        writer.write(b'["BOX", [1, 1, 1]]\n')
+        writer.write(b'[' * 5000 + b'\n')
+        writer.write(json.dumps(packages[0]).encode() + b'\n')
+        writer.write(b'[' + b' ' * 100_000 + b']\n')
+        writer.write(json.dumps(packages[1]).encode() + b'\n')
+        writer.write_eof()
+        replies = [
+            line.decode().rstrip('\n')
+            for line in [await reader.readline() for _ in range(count + 5)]
+        ]
+        assert await reader.readline() == b''
+        writer.close()
+        return replies
+
+    async def slow_client(port):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'["RUN", [15000, 1, 75]]\n' * 5000)
+        await asyncio.sleep(1)
+        writer.close()
+
+    async def run():
+        server = homework.PacketServer(batch_size=16, max_pending=8)
+        tcp_server = await server.start()
+        port = tcp_server.sockets[0].getsockname()[1]
+        stalled = asyncio.ensure_future(slow_client(port))
+        await asyncio.sleep(0.1)
+        results = await asyncio.wait_for(
+            asyncio.gather(*(client(port, 30) for _ in range(5))), 5
+        )
+        await stalled
+        tcp_server.close()
+        await tcp_server.wait_closed()
+        server.close()
+        return results
+
+    for replies in asyncio.run(run()):
+        assert replies[:30] == [expected[index % 3] for index in range(30)], (
+            'Сервер должен отвечать каждому клиенту '
+            'сообщениями в порядке пакетов.'
+        )
+        assert all(reply.startswith('Ошибка') for reply in replies[30:32]), (
+            'На неверный пакет сервер должен отвечать ошибкой.'
+        )
+        assert replies[32] == expected[0], (
+            'После пакета, сломавшего разбор, сервер должен '
+            'продолжать отвечать.'
+        )
+        assert replies[33].startswith('Ошибка') and replies[34] == (
+            expected[1]
+        ), 'На слишком длинную строку сервер должен отвечать ошибкой.'
+
+
+def test_benchmark_report():
+    import benchmark
+
+    for workout_type in benchmark.WORKOUT_TYPES:
+        for packet in benchmark.generate_packets(workout_type, 20):
+            homework.read_package(*packet).show_training_info()
+    report = benchmark.run_benchmarks([30], ('RUN',))
+    names = {result['name'] for result in report['results']}
+    for name in ('read_package', 'get_spent_calories', 'get_message',
+                 'main', 'info_message_memory'):
+        assert name in names, f'В замерах нет этапа `{name}`.'
+    lines = benchmark.compare(report, report)
+    assert lines and all(line.endswith('1.00x') for line in lines), (
+        'Сравнение прогона с самим собой должно давать 1.00x.'
+    )
+
+
+def test_TrainingAggregator():
+    from datetime import date
+
+    running = homework.read_package('RUN', [15000, 1, 75]).show_training_info()
+    swimming = homework.read_package(
+        'SWM', [720, 1, 80, 25, 40]).show_training_info()
+    first = homework.TrainingAggregator()
+    second = homework.TrainingAggregator()
+    first.extend([
+        ('anna', running, date(2024, 3, 4)),
+        ('anna', swimming, date(2024, 3, 5)),
+    ])
+    second.add('anna', running, date(2024, 3, 31))
+    second.add('boris', running, date(2024, 3, 4))
+    first.merge(second)
+
+    day = first.get_totals('anna', 'day', date(2024, 3, 4))
+    assert (day.count, day.distance) == (1, running.distance), (
+        'Итоги за день должны включать только тренировки этого дня.'
+    )
+    week = first.get_totals('anna', 'week', date(2024, 3, 10))
+    assert week.count == 2 and week.calories == (
+        running.calories + swimming.calories
+    ), 'Итоги за неделю должны суммировать тренировки недели.'
+    month = first.get_totals('anna', 'month', date(2024, 3, 1), 'Running')
+    assert (month.count, month.duration) == (2, 2), (
+        'Итоги по типу тренировки должны учитывать только этот тип.'
+    )
+    assert first.get_totals('boris', 'month', date(2024, 3, 1)).count == 1
+    assert first.get_totals('anna', 'day', date(2024, 3, 6)).count == 0
+    with pytest.raises(ValueError):
+        first.get_totals('anna', 'year', date(2024, 3, 1))
+
+
+def test_column_files(tmp_path):
+    packages = [
+        ('SWM', [720, 1, 80, 25, 40]),
+        ('RUN', [15000, 1, 75]),
+        ('WLK', [9000, 1, 75, 180]),
+        ('RUN', [1206, 12, 6]),
+        ('WLK', [420, 4, 20, 42]),
+    ]
+    expected = [homework.read_package(*package).show_training_info()
+                for package in packages]
+    packets_path = str(tmp_path / 'packets.bin')
+    messages_path = str(tmp_path / 'messages.bin')
+    assert homework.save_packets(packets_path, packages) == len(packages)
+    assert homework.save_messages(messages_path, expected) == len(packages)
+
+    with homework.ColumnFile(packets_path) as packets:
+        assert len(packets) == len(packages)
+        assert [
+            homework.read_package(*packet).show_training_info()
+            for packet in packets.iter_packets()
+        ] == expected, (
+            'Пакеты из колоночного файла должны давать те же результаты.'
+        )
+        with pytest.raises(ValueError):
+            list(packets.iter_messages())
+    with homework.ColumnFile(messages_path) as messages:
+        assert list(messages.iter_messages()) == expected, (
+            'Сообщения из колоночного файла должны совпадать с исходными.'
+        )
+    (tmp_path / 'short.bin').write_bytes(b'FTPK')
+    (tmp_path / 'names.bin').write_bytes(
+        homework.COLUMNS_HEADER.pack(b'FTPK', 1, 3, 6, 10))
+    (tmp_path / 'name.bin').write_bytes(
+        homework.COLUMNS_HEADER.pack(b'FTPK', 1, 3, 6, 10) + b'\x05RU')
+    for path in (__file__, str(tmp_path / 'short.bin'),
+                 str(tmp_path / 'names.bin'), str(tmp_path / 'name.bin')):
+        with pytest.raises(ValueError):
+            homework.ColumnFile(path)
+
+    pytest.importorskip('numpy')
+    with homework.ColumnFile(packets_path) as packets:
+        distance, speed, calories = packets.get_batch_metrics()
+    assert list(calories) == [info.calories for info in expected], (
+        'Метрики пачки по колоночному файлу должны совпадать '
+        'с `show_training_info`.'
+    )
+
+
+def test_Instrumentation(tmp_path):
+    import json
+
+    original = homework.read_package
+    with homework.Instrumentation() as instrumentation:
+        for package in [('RUN', [15000, 1, 75]), ('RUN', [1206, 12, 6]),
+                        ('SWM', [720, 1, 80, 25, 40])]:
+            homework.main(homework.read_package(*package))
+    assert homework.read_package is original, (
+        'После выключения замеров функции должны стать исходными.'
+    )
+    stats = instrumentation.stats
+    for stage in ('read_package', 'get_distance', 'get_spent_calories',
+                  'get_message'):
+        assert stats[(stage, 'Running')].count == 2, (
+            f'Этап `{stage}` должен учитываться по типу тренировки.'
+        )
+    assert stats[('get_mean_speed', 'Swimming')].count == 1
+    assert sum(stats[('read_package', 'Running')].buckets) == 2
+
+    json_path = tmp_path / 'stats.json'
+    instrumentation.dump(str(json_path))
+    assert {record['stage'] for record in json.loads(
+        json_path.read_text(encoding='utf-8'))} >= {'read_package'}
+    text = instrumentation.to_prometheus()
+    assert ('homework_stage_seconds_count{stage="read_package",'
+            'training_type="Running"} 2') in text
+    assert ('homework_stage_seconds_bucket{stage="get_message",'
+            'training_type="Swimming",le="+Inf"} 1') in text
+
+
+def test_Instrumentation_bulk_and_keywords():
+    from io import StringIO
+
+    with homework.Instrumentation() as instrumentation:
+        training = homework.read_package(workout_type='RUN',
+                                         data=[15000, 1, 75])
+        homework.process_stream(
+            StringIO('["RUN", [15000, 1, 75]]\n' * 3), StringIO())
+        assert homework.read_package.__name__ == 'read_package'
+    assert training.get_distance() == 9.75, (
+        'С замерами функции должны принимать аргументы по имени.'
+    )
+    stats = instrumentation.stats
+    assert stats[('read_package', 'Running')].count == 4
+    assert stats[('format_messages', 'ALL')].count == 1, (
+        'Пакетное форматирование должно попадать в замеры.'
+    )
+
+
+def test_frames():
+    packages = [
+        ('SWM', [720, 1, 80, 25, 40]),
+        ('RUN', [15000, 1, 75]),
+        ('WLK', [9000, 1.5, 75, 180]),
+    ]
+    frames = [homework.encode_frame(*package) for package in packages]
+    bad = b'XX' + frames[1][2:]
+    body = frames[1][:2] + b'BOX' + frames[1][5:homework.FRAME_BODY_SIZE]
+    unknown = body + struct.pack('<I', zlib.crc32(body))
+    buffer = b''.join(frames[:2] + [bad] + frames[2:] + [unknown]) + b'FT'
+    size = homework.FRAME.size
+
+    errors = []
+    packets = list(homework.iter_frames(buffer, errors))
+    assert packets == packages, (
+        'Функция `iter_frames` должна возвращать исправные пакеты.'
+    )
+    assert [error.offset for error in errors] == [
+        2 * size, 4 * size, 5 * size
+    ], 'Испорченные кадры должны сообщаться со смещениями.'
+    assert [error.reason for error in errors] == [
+        'неверный маркер кадра', "неизвестный код тренировки b'BOX'",
+        'обрезанный кадр'
+    ]
+
+    pytest.importorskip('numpy')
+    workout_types, columns, batch_errors = homework.parse_frames(buffer)
+    assert batch_errors == errors, (
+        'Функция `parse_frames` должна находить те же испорченные кадры.'
+    )
+    assert list(workout_types) == ['SWM', 'RUN', 'WLK']
+    distance, speed, calories = homework.get_batch_metrics(
+        workout_types, **columns)
+    assert list(calories) == [
+        homework.read_package(*package).show_training_info().calories
+        for package in packages
+    ]
+
+
+@pytest.mark.parametrize('damage', ['truncate', 'flip', 'flip_two'])
+def test_frames_resync(damage):
+    packages = [
+        ('SWM', [720, 1, 80, 25, 40]),
+        ('RUN', [21574, 1, 75]),
+        ('WLK', [9000, 1.5, 75, 180]),
+        ('RUN', [1206, 12, 6]),
+        ('WLK', [420, 4, 20, 42]),
+    ]
+    frames = [homework.encode_frame(*package) for package in packages]
+    assert homework.FRAME_MARKER in frames[1][2:], (
+        'Шаг 21574 кодируется байтами маркера внутри данных кадра.'
+    )
+    size = homework.FRAME.size
+    damaged = [1]
+    if damage == 'truncate':
+        frames[1] = frames[1][:20]
+        expected = [(size, 'обрезанный кадр')]
+    else:
+        if damage == 'flip_two':
+            damaged.append(2)
+        for index in damaged:
+            frames[index] = frames[index][:20] + b'\xff' + frames[index][21:]
+        expected = [(index * size, 'неверная контрольная сумма')
+                    for index in damaged]
+    buffer = b''.join(frames)
+    good = [package for index, package in enumerate(packages)
+            if index not in damaged]
+
+    for source in (buffer, memoryview(buffer)):
+        errors = []
+        assert list(homework.iter_frames(source, errors)) == good, (
+            'После испорченного кадра разбор должен продолжаться.'
+        )
+        assert [(error.offset, error.reason) for error in errors] == (
+            expected
+        ), 'Каждый испорченный кадр должен сообщаться один раз по смещению.'
+
+    pytest.importorskip('numpy')
+    workout_types, columns, batch_errors = homework.parse_frames(buffer)
+    assert batch_errors == errors
+    assert list(workout_types) == [workout_type for workout_type, _ in good]
+    assert list(columns['action']) == [data[0] for _, data in good]
+
+
+def test_import_budget():
+    import subprocess
+    import sys
+
+    code = (
+        'import sys; import homework; '
+        "print(' '.join(sorted(sys.modules)))"
+    )
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=str(BASE_DIR), capture_output=True, text=True,
+        check=True
+    )
+    modules = set(result.stdout.split())
+    for heavy in ('numpy', 'asyncio', 'concurrent.futures', 'multiprocessing',
+                  'argparse', 'csv', 'json', 'mmap'):
+        assert heavy not in modules, (
+            f'`import homework` не должен импортировать `{heavy}`.'
+        )
+    homework_line = [line for line in result.stderr.splitlines()
+                     if line.rstrip().endswith('| homework')][0]
+    cumulative_us = int(homework_line.split('|')[1])
+    assert cumulative_us < 200_000, (
+        '`import homework` должен укладываться в 200 мс.'
+    )
+
+
+@pytest.mark.parametrize('argv, expected', [
+    (['--types', 'SWM'], ['Swimming']),
+    (['-t', 'json'], ['Running', 'Swimming']),
+])
+def test_cli(tmp_path, argv, expected):
+    import json
+
+    source = tmp_path / 'packets.csv'
+    source.write_text('RUN,15000,1,75\nSWM,720,1,80,25,40\n')
+    output = tmp_path / 'out.txt'
+    homework.cli([str(source), '-o', str(output)] + argv)
+    lines = output.read_text(encoding='utf-8').splitlines()
+    if '-t' in argv:
+        assert [json.loads(line)['training_type'] for line in lines] == (
+            expected
+        )
+    else:
+        assert [line.split(';')[0].split(': ')[1] for line in lines] == (
+            expected
+        ), 'Фильтр `--types` должен оставлять только выбранные тренировки.'
+
+
+def test_cli_demo():
+    with Capturing() as output:
+        homework.cli([])
+    assert len(output) == 3 and output[0].startswith(
+        'Тип тренировки: Swimming'
+    ), 'Без входного файла должны выводиться демонстрационные пакеты.'
+
+
+@pytest.mark.parametrize('input_data', [
+    ('SWM', [720, 1, 80, 25, 40]),
+    ('SWM', [1206, 12, 6, 12, 6]),
+    ('RUN', [15000, 1, 75]),
+    ('RUN', [1206, 12, 6]),
+    ('WLK', [9000, 1, 75, 180]),
+    ('WLK', [420, 4, 20, 42]),
+    ('WLK', [12000, 1.5, 82.5, 176]),
+])
+def test_show_fixed_training_info(input_data):
+    training = homework.read_package(*input_data)
+    fixed = training.show_fixed_training_info()
+    exact = training.show_training_info()
+    assert abs(fixed.distance - exact.distance) <= 1e-6
+    assert abs(fixed.speed - exact.speed) <= 1e-6
+    assert abs(fixed.calories - exact.calories) <= 1e-3, (
+        'Расчёт в фиксированной точке должен совпадать с float '
+        'в пределах допуска.'
+    )
+    assert fixed.get_message() == exact.get_message()
+
+    pytest.importorskip('numpy')
+    workout_type, data = input_data
+    columns = dict(zip(homework.TRAININGS[workout_type].PARAMETERS,
+                       ([value] for value in data)))
+    distance, speed, calories = homework.get_batch_metrics(
+        [workout_type], fixed=True, **columns)
+    assert (distance[0], speed[0], calories[0]) == (
+        fixed.distance, fixed.speed, fixed.calories
+    ), 'Пакетный расчёт в фиксированной точке должен совпадать побитно.'
+
+
+def test_fixed_overflow():
+    pytest.importorskip('numpy')
+    with pytest.raises(OverflowError):
+        homework.get_batch_metrics(['RUN'], [10 ** 12], [1], [10 ** 6],
+                                   fixed=True)
+
+
+def test_TrainingSeries():
+    series = homework.TrainingSeries('RUN', window=3, weight=75)
+    steps = [3, 2, 3, 4, 2, 3]
+    curve = []
+    for action in steps:
+        series.append(action)
+        curve.append(series.get_window_info())
+    assert curve == list(series.iter_window_infos()), (
+        'Кривая окна должна совпадать с метриками окна после отсчёта.'
+    )
+    assert curve[-1] == homework.Running(
+        sum(steps[-3:]), 3 / 3600, 75).show_training_info(), (
+        'Метрики окна должны считаться по формулам `Running`.'
+    )
+    assert curve[0].duration == 1 / 3600
+
+    lap = series.mark_lap()
+    assert lap == homework.Running(
+        sum(steps), 6 / 3600, 75).show_training_info()
+    with pytest.raises(ValueError):
+        series.mark_lap()
+
+
+def test_TrainingSeries_swimming():
+    series = homework.TrainingSeries(
+        'SWM', window=10, sample_seconds=30, weight=80, length_pool=25)
+    series.extend([20, 22, 21], [1, 0, 1])
+    assert series.get_window_info() == homework.Swimming(
+        63, 90 / 3600, 80, 25, 2).show_training_info(), (
+        'Для плавания окно должно учитывать пройденные бассейны.'
+    )
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_ShardedJob_resume(tmp_path, monkeypatch, workers):
+    packages = [
+        ('SWM', [720, 1, 80, 25, 40]),
+        ('RUN', [15000, 1, 75]),
+        ('WLK', [9000, 1, 75, 180]),
+    ] * 3 + [('RUN', [1206, 12, 6])]
+    source = tmp_path / 'packets.csv'
+    source.write_text(''.join(
+        ','.join(map(str, [workout_type] + data)) + '\n'
+        for workout_type, data in packages
+    ))
+    output_dir = str(tmp_path / 'out')
+    expected = [
+        homework.read_package(*package).show_training_info().get_message()
+        for package in packages
+    ]
+    original = homework.process_shard
+
+    def crash_on_third_shard(lines, fmt, path):
+        if path.endswith('shard-00002.txt'):
+            raise KeyboardInterrupt
+        return original(lines, fmt, path)
+
+    monkeypatch.setattr(homework, 'process_shard', crash_on_third_shard)
+    job = homework.ShardedJob(str(source), output_dir, 'csv', shard_size=2)
+    with pytest.raises(KeyboardInterrupt):
+        job.run()
+    assert sorted(job.manifest['shards']) == ['0', '1'], (
+        'Готовые шарды должны сохраняться в манифесте до сбоя.'
+    )
+    monkeypatch.setattr(homework, 'process_shard', original)
+
+    job = homework.ShardedJob(str(source), output_dir, 'csv', shard_size=2,
+                              workers=workers)
+    assert job.run() == 3, 'При перезапуске готовые шарды пропускаются.'
+    assert [line.rstrip('\n') for line in job.iter_messages()] == expected
+    assert homework.ShardedJob(str(source), output_dir, 'csv',
+                               shard_size=2).run() == 0
+    with pytest.raises(ValueError):
+        homework.ShardedJob(str(source), output_dir, 'csv', shard_size=3)
+
+    stat = source.stat()
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    with pytest.raises(ValueError):
+        homework.ShardedJob(str(source), output_dir, 'csv', shard_size=2)
+    with source.open('a') as appended:
+        appended.write('RUN,15000,1,75\n')
+    with pytest.raises(ValueError, match='source_size'):
+        homework.ShardedJob(str(source), output_dir, 'csv', shard_size=2)
+
+
+def test_thread_safety():
+    import sys
+    import threading
+    from datetime import date
+
+    packages = [
+        ('SWM', [720, 1, 80, 25, 40]),
+        ('RUN', [15000, 1, 75]),
+        ('WLK', [9000, 1, 75, 180]),
+        ('RUN', [1206, 12, 6]),
+    ]
+    message = homework.read_package(*packages[1]).show_training_info()
+    cache = homework.InfoMessageCache(maxsize=3)
+    aggregator = homework.TrainingAggregator()
+    instrumentation = homework.Instrumentation()
+    threads_count, rounds = 8, 500
+    barrier = threading.Barrier(threads_count)
+
+    def work():
+        barrier.wait()
+        for index in range(rounds):
+            cache.get_info(*packages[index % len(packages)])
+            aggregator.add('anna', message, date(2024, 3, 4))
+            instrumentation.record('get_message', 'Running', 1e-6)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=work)
+                   for _ in range(threads_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+    total = threads_count * rounds
+    info = cache.cache_info()
+    assert info.hits + info.misses == total, (
+        'Каждое обращение к кешу должно учитываться ровно один раз.'
+    )
+    assert info.size <= info.maxsize
+    assert aggregator.get_totals('anna', 'week', date(2024, 3, 4)).count == (
+        total
+    ), 'Итоги, собранные из потоков, не должны терять тренировки.'
+    assert instrumentation.stats[('get_message', 'Running')].count == total
+
+    packets = packages * 50
+    assert list(homework.get_messages_threaded(
+        packets, chunk_size=7, max_workers=4
+    )) == homework.get_messages(packets), (
+        'Сообщения из пула потоков должны идти в порядке пакетов.'
+    )
+
+
+@pytest.mark.parametrize('input_data, expected', [
+    (('RUN', [15000, 0, 75]), 'zero_duration'),
+    (('SWM', [720, 1, -80, 25, 40]), 'negative_weight'),
+    (('RUN', [-1, 1, 75]), 'action_range'),
+    (('RUN', [10 ** 9, 1, 75]), 'action_range'),
+    (('WLK', [9000, 1, 75, 0]), 'zero_height'),
+    (('BIK', [9000, 1, 75]), 'unknown_type'),
+    (('RUN', [15000, 1]), 'arity'),
+    (('RUN', [15000, '1', 75]), 'not_number'),
+    (('RUN', [15000, float('nan'), 75]), 'not_finite'),
+    (('SWM', [720, 1, float('inf'), 25, 40]), 'not_finite'),
+    (('WLK', [9000, 1, 75, float('-inf')]), 'not_finite'),
+    (('RUN', [10 ** 400, 1, 75]), 'not_finite'),
+    (('RUN', None), 'arity'),
+    (('RUN', 5), 'arity'),
+    ((['RUN'], [15000, 1, 75]), 'unknown_type'),
+    ((None, [15000, 1, 75]), 'unknown_type'),
+    (('WLK', [9000, 1, 75, 180]), None),
+])
+def test_check_packet(input_data, expected):
+    assert homework.check_packet(*input_data) == expected, (
+        f'Для пакета {input_data} ожидается код причины {expected}.'
+    )
+
+
+def test_filter_packets(tmp_path):
+    import io
+    import json
+
+    packages = [
+        ('SWM', [720, 1, 80, 25, 40]),
+        ('RUN', [15000, 0, 75]),
+        ('WLK', [9000, 1, 75, 180]),
+        ('WLK', [9000, 1, 75, 0]),
+    ]
+    quarantine = []
+    assert list(homework.filter_packets(packages, quarantine)) == (
+        packages[::2]
+    ), 'Пакеты с отклонениями не должны доходить до расчёта.'
+    assert [(anomaly.index, anomaly.reason) for anomaly in quarantine] == [
+        (1, 'zero_duration'), (3, 'zero_height')
+    ]
+
+    source = io.StringIO(''.join(json.dumps(package) + '\n'
+                                 for package in packages))
+    quarantine = []
+    assert homework.process_stream(source, io.StringIO(),
+                                   quarantine=quarantine) == 2
+    assert len(quarantine) == 2
+
+    source = tmp_path / 'packets.csv'
+    source.write_text('RUN,15000,1,75\nRUN,15000,0,75\n')
+    output = tmp_path / 'out.txt'
+    rejected = tmp_path / 'rejected.jsonl'
+    homework.cli([str(source), '-o', str(output),
+                  '--quarantine', str(rejected)])
+    assert len(output.read_text(encoding='utf-8').splitlines()) == 1
+    assert [json.loads(line)['reason']
+            for line in rejected.read_text(encoding='utf-8').splitlines()
+            ] == ['zero_duration'], (
+        'Отложенные пакеты должны записываться в файл `--quarantine`.'
+    )
+
+    source = tmp_path / 'packets.jsonl'
+    source.write_text('["RUN", [15000, NaN, 75]]\n["RUN", 5]\n'
+                      '[["RUN"], [15000, 1, 75]]\n["RUN", [15000, 1, 75]]\n')
+    homework.cli([str(source), '-o', str(output),
+                  '--quarantine', str(rejected)])
+    assert len(output.read_text(encoding='utf-8').splitlines()) == 1
+    assert [json.loads(line)['reason']
+            for line in rejected.read_text(encoding='utf-8').splitlines()
+            ] == ['not_finite', 'arity', 'unknown_type'], (
+        'NaN, данные не списком и неверный код должны откладываться, '
+        'а не останавливать поток.'
+    )
+
+    source = tmp_path / 'malformed.jsonl'
+    source.write_text('{not json\n{"foo": 1}\n["RUN"]\n'
+                      '["RUN", [15000, 1, 75]]\n')
+    homework.cli([str(source), '-o', str(output),
+                  '--quarantine', str(rejected)])
+    assert len(output.read_text(encoding='utf-8').splitlines()) == 1
+    assert [json.loads(line)
+            for line in rejected.read_text(encoding='utf-8').splitlines()
+            ] == [
+        {'index': 0, 'workout_type': None, 'data': '{not json',
+         'reason': 'malformed'},
+        {'index': 1, 'workout_type': None, 'data': '{"foo": 1}',
+         'reason': 'malformed'},
+        {'index': 2, 'workout_type': None, 'data': '["RUN"]',
+         'reason': 'malformed'},
+    ], 'Нераспознанные строки должны откладываться с исходным текстом.'
+
+    source = tmp_path / 'malformed.csv'
+    source.write_text('RUN,abc,1,75\nRUN,15000,1,75\n')
+    homework.cli([str(source), '-o', str(output),
+                  '--quarantine', str(rejected)])
+    assert len(output.read_text(encoding='utf-8').splitlines()) == 1
+    assert [(record['index'], record['data'], record['reason'])
+            for record in map(json.loads, rejected.read_text(
+                encoding='utf-8').splitlines())
+            ] == [(0, 'RUN,abc,1,75', 'malformed')]
+
+    quarantine = []
+    source = io.StringIO('["RUN", [15000, 0, 75]]\n{not json\n'
+                         '["RUN", [15000, 1, 75]]\n')
+    assert homework.process_stream(source, io.StringIO(),
+                                   quarantine=quarantine) == 1
+    assert [(anomaly.index, anomaly.reason) for anomaly in quarantine] == [
+        (0, 'zero_duration'), (1, 'malformed')
+    ], 'Номера отложенных записей должны совпадать с номерами строк.'
+    with pytest.raises(ValueError):
+        list(homework.read_packets(io.StringIO('{not json\n')))
+
+
+def test_filter_batch():
+    np = pytest.importorskip('numpy')
+
+    packages = [
+        ('SWM', [720, 1, 80, 25, 40]),
+        ('RUN', [15000, 0, 75]),
+        ('WLK', [9000, 1, 75, 180]),
+        ('WLK', [9000, 1, 75, 0]),
+        ('RUN', [10 ** 9, 1, -75]),
+        ('RUN', [1206, 12, 6]),
+        ('SWM', [720, float('nan'), 80, 25, 40]),
+        ('RUN', [10 ** 9, float('inf'), 75]),
+    ]
+    codes = [workout_type for workout_type, _ in packages]
+    columns = {
+        name: np.array([
+            dict(zip(homework.TRAININGS[workout_type].PARAMETERS, data))
+            .get(name, 0)
+            for workout_type, data in packages
+        ], dtype=float)
+        for name in homework.PACKET_COLUMNS
+    }
+    reasons = homework.check_batch(codes, columns)
+    assert list(reasons) == [
+        homework.check_packet(*package) or '' for package in packages
+    ], 'Векторная проверка должна совпадать с проверкой по пакетам.'
+
+    valid_codes, valid_columns, anomalies = homework.filter_batch(
+        codes, columns)
+    assert [anomaly.index for anomaly in anomalies] == [1, 3, 4, 6, 7]
+    assert anomalies[0].data == packages[1][1]
+    calories = homework.get_batch_metrics(valid_codes, **valid_columns)[2]
+    assert list(calories) == [
+        homework.read_package(*package).get_spent_calories()
+        for package in packages if homework.check_packet(*package) is None
+    ]
+    valid_columns = {name: values[[0, 2, 5]]
+                     for name, values in columns.items()}
+    assert homework.filter_batch(['SWM', 'WLK', 'RUN'], valid_columns)[1] is (
+        valid_columns
+    ), 'Пачка без отклонений должна возвращаться без копирования.'
+
+
+def get_random_messages(count):
+    import random
+
+    import benchmark
+
+    rng = random.Random(0)
+    return [
+        homework.read_package(*benchmark.generate_packet(
+            benchmark.WORKOUT_TYPES[index % 3], rng
+        )).show_training_info()
+        for index in range(count)
+    ]
+
+
+def test_TopMessages():
+    messages = get_random_messages(3000)
+    first = homework.TopMessages(k=10)
+    second = homework.TopMessages(k=10)
+    first.extend(messages[:1000])
+    second.extend(messages[1000:])
+    first.merge(second)
+    exact = sorted(messages, key=lambda message: message.calories,
+                   reverse=True)
+    assert first.get_top() == exact[:10], (
+        'Отбор лучших должен совпадать с полной сортировкой.'
+    )
+    assert first.get_top('Running') == [
+        message for message in exact if message.training_type == 'Running'
+    ][:10], 'Лучшие тренировки должны отбираться по каждому типу.'
+    assert all(len(heap) <= 10 for heap in first.heaps.values())
+    assert first.get_top('Cycling') == []
+    with pytest.raises(ValueError):
+        first.merge(homework.TopMessages(k=10, field_name='speed'))
+
+
+@pytest.mark.parametrize('field_name', ['speed', 'distance', 'calories'])
+def test_MessageQuantiles(field_name):
+    messages = get_random_messages(6000)
+    first = homework.MessageQuantiles(relative_accuracy=0.01)
+    second = homework.MessageQuantiles(relative_accuracy=0.01)
+    first.extend(messages[:2500])
+    for message in messages[2500:]:
+        second.add(message)
+    first.merge(second)
+    values = sorted(getattr(message, field_name) for message in messages)
+    for q in (0, 0.5, 0.95, 0.99, 1):
+        exact = values[int(q * (len(values) - 1))]
+        assert abs(first.quantile(field_name, q) - exact) <= (
+            0.01 * abs(exact)
+        ), (
+            f'Квантиль {q} поля `{field_name}` должен быть точен до 1%.'
+        )
+    with pytest.raises(ValueError):
+        first.quantile('weight', 0.5)
+
+
+def test_QuantileSketch():
+    sketch = homework.QuantileSketch(relative_accuracy=0.05, max_buckets=20)
+    sketch.extend([-100, -1, 0, 0] + [1.1 ** power for power in range(200)])
+    assert sketch.count == 204
+    assert len(sketch.positive) <= 20, 'Число корзин должно быть ограничено.'
+    assert sketch.quantile(0) == pytest.approx(-100, rel=0.05)
+    assert sketch.quantile(2 / 203) == 0
+    assert sketch.quantile(1) == pytest.approx(1.1 ** 199, rel=0.05)
+    with pytest.raises(ValueError):
+        homework.QuantileSketch().quantile(0.5)
+    with pytest.raises(ValueError):
+        sketch.merge(homework.QuantileSketch(relative_accuracy=0.01))
+
+    nan, inf = float('nan'), float('inf')
+    sketch = homework.QuantileSketch()
+    sketch.extend([nan, inf, -inf, 1.0, 0])
+    sketch.add(nan)
+    sketch.add(inf)
+    assert (sketch.count, sketch.zero, sketch.non_finite) == (2, 1, 5), (
+        'NaN и бесконечности не должны попадать в квантили.'
+    )
+    assert sketch.quantile(1) == pytest.approx(1, rel=0.01)
+    other = homework.QuantileSketch()
+    other.add(-inf)
+    sketch.merge(other)
+    assert sketch.non_finite == 6
+
+
+@pytest.mark.parametrize('input_data', [
+    ('RUN', [40000, 7 / 60, 180]),
+    ('RUN', [10 ** 6, 0.5, 200]),
+    ('RUN', [10 ** 6, 0.001, 120]),
+    ('SWM', [2263, 419 / 3600, 142.3, 46.5, 166]),
+    ('SWM', [5000, 1 / 3600, 90, 50, 300]),
+    ('WLK', [31415, 2718 / 3600, 77.7, 181]),
+    ('WLK', [10 ** 6, 0.01, 80, 175]),
+])
+def test_fixed_point_bounds(input_data):
+    training = homework.read_package(*input_data)
+    fixed = training.show_fixed_training_info()
+    exact = training.show_training_info()
+    duration = training.duration
+    assert abs(fixed.distance - exact.distance) <= 1e-6
+    assert abs(fixed.speed - exact.speed) <= (
+        1e-6 + exact.speed * 1e-6 / duration
+    ), 'Ошибка скорости должна укладываться в описанную границу.'
+    assert abs(fixed.calories - exact.calories) <= (
+        1e-3 + abs(exact.calories) * 1e-6 / duration
+    ), 'Ошибка калорий должна укладываться в описанную границу.'
+
+    pytest.importorskip('numpy')
+    workout_type, data = input_data
+    columns = dict(zip(homework.TRAININGS[workout_type].PARAMETERS,
+                       [[value] for value in data]))
+    assert [values[0] for values in homework.get_batch_metrics(
+        [workout_type], fixed=True, **columns
+    )] == [fixed.distance, fixed.speed, fixed.calories], (
+        'Пачка в фиксированной точке не должна переполняться '
+        'в допустимом диапазоне.'
+    )
+
+
+def test_fixed_point_overflow():
+    pytest.importorskip('numpy')
+    with pytest.raises(OverflowError):
+        homework.get_batch_metrics(['WLK'], [10 ** 6], [1e-4], [500],
+                                   height=[100], fixed=True)
+    assert homework.read_package(
+        'WLK', [10 ** 6, 1e-4, 500, 100]
+    ).show_fixed_training_info().distance == 650